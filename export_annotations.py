@@ -8,22 +8,259 @@ from tkinter import ttk, filedialog, messagebox
 import sqlite3
 import os
 import json
-from joppy.client_api import ClientApi
 import xml.etree.ElementTree as ET
 import win32api
+import win32con
+import win32file
 import string
 import requests
-import socket
 from urllib.parse import urljoin
+from urllib.request import pathname2url
 from datetime import datetime
 import sys
-from PIL import Image, ImageTk
+import functools
+import logging
+import multiprocessing
+import atexit
+import importlib.util
 import io
 import tempfile
-import cairosvg
-import base64
+import threading
 import re
-import shutil
+import zipfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+# orjson parses and writes JSON faster when it is installed; json.loads takes bytes as well
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    orjson = None
+    _json_loads = json.loads
+
+# Parsed JSON and template files, keyed by (path, mtime_ns)
+_CONFIG_CACHE = {}
+
+def invalidate_json_cache(path):
+    """Forget any cached parse result for the given path."""
+    for key in [k for k in _CONFIG_CACHE if k[0] == path]:
+        del _CONFIG_CACHE[key]
+
+def _load_cached(path, parse, mode='r', **open_kwargs):
+    key = (path, os.stat(path).st_mtime_ns)
+    if key not in _CONFIG_CACHE:
+        # Drop the stale entry from a previous version of the file
+        invalidate_json_cache(path)
+        with open(path, mode, **open_kwargs) as f:
+            _CONFIG_CACHE[key] = parse(f)
+    return _CONFIG_CACHE[key]
+
+def load_json_cached(path):
+    """Load a JSON file, reusing the parsed result while the file is unchanged."""
+    # The whole file is parsed from bytes in one call, skipping text decoding
+    return _load_cached(path, lambda f: _json_loads(f.read()), 'rb')
+
+def save_json(path, data):
+    """Write data to a JSON file as indented text and drop its cached parse."""
+    if orjson is not None:
+        encoded = orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    else:
+        encoded = json.dumps(data, indent=4).encode()
+    # The text is encoded before the file is opened, so a failure leaves it intact
+    with open(path, 'wb') as f:
+        f.write(encoded)
+    invalidate_json_cache(path)
+
+def load_text_cached(path, **open_kwargs):
+    """Read a text file, reusing the contents while the file is unchanged."""
+    return _load_cached(path, lambda f: f.read(), **open_kwargs)
+
+# Directory of the script or executable, where the configuration files live
+if getattr(sys, 'frozen', False):
+    # Running as compiled executable
+    _BASE_PATH = os.path.dirname(sys.executable)
+else:
+    # Running as script
+    _BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+_CONFIG_PATH = os.path.join(_BASE_PATH, 'config.json')
+_CHAPTER_FORMATS_PATH = os.path.join(_BASE_PATH, 'chapter_formats.json')
+
+# Leading "YYYY-MM-DD[T ]HH:MM:SS" of a Kobo DateCreated value
+_KOBO_DATE_RE = re.compile(r'(\d{4}-\d{2}-\d{2})[T ](\d{2}:\d{2}:\d{2})')
+
+# Root paths of all possible drive letters, in GetLogicalDrives bit order
+_DRIVE_LETTERS = tuple(f"{letter}:\\" for letter in string.ascii_uppercase)
+
+# Drive types a Kobo can show up as
+_KOBO_DRIVE_TYPES = (win32con.DRIVE_REMOVABLE, win32con.DRIVE_FIXED)
+
+# Chapter file name in OEBPS/partXXXX.xhtml content IDs
+_OEBPS_PART_RE = re.compile(r'part(\d+)\.xhtml')
+
+def format_kobo_date(date_created):
+    """Format a Kobo DateCreated value as 'YYYY-MM-DD HH:MM:SS'."""
+    if isinstance(date_created, str):
+        # Kobo writes "YYYY-MM-DDTHH:MM:SSZ", which only needs slicing
+        if len(date_created) == 20 and date_created[10] == 'T' and date_created[19] == 'Z':
+            return f"{date_created[:10]} {date_created[11:19]}"
+        # Other ISO timestamps need no parsing either
+        match = _KOBO_DATE_RE.match(date_created)
+        if match:
+            return f"{match.group(1)} {match.group(2)}"
+    try:
+        if isinstance(date_created, str):
+            # fromisoformat only accepts a trailing Z from Python 3.11
+            date_obj = datetime.fromisoformat(date_created.rstrip('Z'))
+        else:
+            date_obj = datetime.fromtimestamp(int(date_created))
+        return date_obj.strftime('%Y-%m-%d %H:%M:%S')
+    except (ValueError, TypeError):
+        return "Unknown Date"
+
+_CONTAINER_NS = '{urn:oasis:names:tc:opendocument:xmlns:container}'
+_DC_NS = '{http://purl.org/dc/elements/1.1/}'
+
+def read_epub_metadata(epub_path):
+    """Read the title and author of an EPUB from its package document only."""
+    with zipfile.ZipFile(epub_path) as archive:
+        container = ET.fromstring(archive.read('META-INF/container.xml'))
+        rootfile = container.find(f'.//{_CONTAINER_NS}rootfile')
+        package = ET.fromstring(archive.read(rootfile.get('full-path')))
+    title = package.find(f'.//{_DC_NS}title')
+    creator = package.find(f'.//{_DC_NS}creator')
+    return ((title.text or "") if title is not None else "",
+            (creator.text or "") if creator is not None else "")
+
+# Most processes merging markups with their pages at the same time
+MARKUP_MERGE_WORKERS = 4
+
+# Notes written to Joplin at the same time during an export. The writers
+# share joppy's session, whose connection pool is sized to match
+JOPLIN_WRITE_WORKERS = 4
+
+# Separator between the timestamped sections of a note, and the line
+# naming a section's timestamp
+NOTE_SECTION_SEPARATOR = '\n\n---\n\n'
+_TIMESTAMP_RE = re.compile(r'^Timestamp: (.*)$', re.M)
+
+# First line of a section written by merge_contents: its timestamp in epoch
+# seconds, hidden by Joplin's markdown renderer
+_SECTION_TS_PREFIX = '<!-- ts:'
+_EPOCH = datetime(1970, 1, 1)
+
+def timestamp_epoch(timestamp):
+    """Return a 'YYYY-MM-DD HH:MM:SS' timestamp or datetime as epoch seconds, or None."""
+    try:
+        if not isinstance(timestamp, datetime):
+            timestamp = datetime.fromisoformat(str(timestamp).rstrip('Z'))
+        return int((timestamp.replace(tzinfo=None) - _EPOCH).total_seconds())
+    except ValueError:
+        return None
+
+# Placeholders in annotation_template.md, e.g. %anno_text%
+_TEMPLATE_TOKEN_RE = re.compile(r'%(\w+)%')
+
+def fill_template(template, fields):
+    """Replace every %name% placeholder found in fields in a single pass; others are kept."""
+    return _TEMPLATE_TOKEN_RE.sub(lambda match: str(fields.get(match.group(1), match.group(0))), template)
+
+# Opening tag of the root <svg> element, and the size attributes on it
+_SVG_ROOT_RE = re.compile(rb'<svg\b[^>]*?(/?)>')
+_SVG_SIZE_ATTR_RE = re.compile(rb'\s(?:viewBox|width|height)\s*=\s*(?:"[^"]*"|\'[^\']*\')')
+
+def resize_svg(svg_content, x, y, width, height, output_size=None):
+    """Set the root viewBox to (x, y, width, height) and the output size to output_size.
+    
+    The output size defaults to width x height. Only the root tag is rewritten;
+    the rest of the document is passed through as bytes. Falls back to an
+    ElementTree round-trip if the tag is not found.
+    """
+    output_width, output_height = output_size or (width, height)
+    size_attrs = f' viewBox="{x} {y} {width} {height}" width="{output_width}" height="{output_height}"'.encode('ascii')
+    match = _SVG_ROOT_RE.search(svg_content)
+    if match:
+        tag = _SVG_SIZE_ATTR_RE.sub(b'', svg_content[match.start():match.start(1)])
+        return svg_content[:match.start()] + tag + size_attrs + svg_content[match.start(1):]
+    
+    svg_tree = ET.fromstring(svg_content)
+    svg_tree.set('viewBox', f'{x} {y} {width} {height}')
+    svg_tree.set('width', str(output_width))
+    svg_tree.set('height', str(output_height))
+    return ET.tostring(svg_tree)
+
+# Parts of a markup SVG that cairosvg would parse and then ignore
+_SVG_METADATA_RE = re.compile(rb'<metadata\b[^>]*>.*?</metadata>|<metadata\b[^>]*/>|<!--.*?-->', re.S)
+_SVG_TAG_GAP_RE = re.compile(rb'>\s+<')
+# Coordinates beyond three decimals, far below a pixel at any render size
+_SVG_PRECISION_RE = re.compile(rb'(\d\.\d{3})\d+')
+
+def strip_svg(svg_content):
+    """Drop metadata, comments, whitespace between tags and excess coordinate precision."""
+    svg_content = _SVG_METADATA_RE.sub(b'', svg_content)
+    svg_content = _SVG_TAG_GAP_RE.sub(b'><', svg_content)
+    return _SVG_PRECISION_RE.sub(rb'\1', svg_content)
+
+def rasterize_svg(svg_bytes):
+    """Rasterize an SVG to an RGBA image, reading cairo's pixels without a PNG round-trip."""
+    from cairosvg.parser import Tree
+    from cairosvg.surface import PNGSurface
+    from PIL import Image
+    
+    # Without an output the surface only draws into its ARGB32 image surface
+    surface = PNGSurface(Tree(bytestring=svg_bytes), None, 96)
+    surface.cairo.flush()
+    # Cairo stores premultiplied ARGB as native-endian words, which are BGRA
+    # bytes on little-endian (Windows) machines
+    image = Image.frombuffer('RGBA', (surface.width, surface.height), bytes(surface.cairo.get_data()),
+                             'raw', 'BGRa', surface.cairo.get_stride(), 1)
+    surface.finish()
+    return image
+
+# WM_DEVICECHANGE events sent when a volume is mounted or removed
+DBT_DEVICEARRIVAL = 0x8000
+DBT_DEVICEREMOVECOMPLETE = 0x8004
+
+def watch_device_changes(on_change):
+    """Call on_change from a background thread whenever a device is added or removed.
+    
+    Listens for WM_DEVICECHANGE on a hidden window. Returns a threading.Event
+    that is set once the window exists; while it is not set, the caller has
+    to poll. The window is created on the background thread, so this does
+    not wait for it.
+    """
+    watching = threading.Event()
+    try:
+        import win32gui
+    except ImportError:
+        return watching
+    
+    def window_proc(hwnd, msg, wparam, lparam):
+        if msg == win32con.WM_DEVICECHANGE and wparam in (DBT_DEVICEARRIVAL, DBT_DEVICEREMOVECOMPLETE):
+            on_change()
+        return win32gui.DefWindowProc(hwnd, msg, wparam, lparam)
+    
+    def pump_messages():
+        try:
+            window_class = win32gui.WNDCLASS()
+            window_class.lpfnWndProc = window_proc
+            window_class.lpszClassName = f"{app_name} device watcher"
+            window_class.hInstance = win32api.GetModuleHandle(None)
+            win32gui.RegisterClass(window_class)
+            # A top-level window, as message-only windows get no device broadcasts
+            win32gui.CreateWindow(window_class.lpszClassName, window_class.lpszClassName,
+                                  0, 0, 0, 0, 0, 0, 0, window_class.hInstance, None)
+        except Exception:
+            # Devices are still found by polling
+            log.warning("Could not watch for device changes", exc_info=True)
+            return
+        watching.set()
+        win32gui.PumpMessages()
+    
+    threading.Thread(target=pump_messages, daemon=True).start()
+    return watching
 
 def get_resource_path(relative_path):
     """Get absolute path to resource, works for dev and for PyInstaller"""
@@ -34,6 +271,7 @@ def get_resource_path(relative_path):
         base_path = os.path.abspath(".")
     return os.path.join(base_path, relative_path)
 
+@functools.lru_cache(maxsize=1)
 def check_dependencies():
     """Check if all required dependencies are installed and accessible."""
     missing_deps = []
@@ -50,10 +288,9 @@ def check_dependencies():
         'cairosvg': 'cairosvg'
     }
     
+    # Only locate the packages; heavy ones are imported when first used
     for module, package in required_packages.items():
-        try:
-            __import__(module)
-        except ImportError:
+        if importlib.util.find_spec(module) is None:
             missing_deps.append(f"Python package '{package}' is not installed")
     
     return missing_deps, download_links
@@ -63,8 +300,10 @@ class KoboToJoplinApp:
         self.root = root
         self.root.title(f"{app_name} - {app_version}")
         
-        # Set window icon
-        icon_path = get_resource_path('app_icon.ico')
+        # Set window icon, preferring icon.ico next to the script or executable
+        icon_path = os.path.join(_BASE_PATH, 'icon.ico')
+        if not os.path.exists(icon_path):
+            icon_path = get_resource_path('app_icon.ico')
         if os.path.exists(icon_path):
             self.root.iconbitmap(icon_path)
         
@@ -75,6 +314,8 @@ class KoboToJoplinApp:
             self.root.destroy()
             return
         
+        self.setup_chapter_patterns()
+        
         # Check dependencies first
         missing_deps, download_links = check_dependencies()
         if missing_deps:
@@ -132,24 +373,24 @@ class KoboToJoplinApp:
             self.root.wait_window(error_window)
             return
         
-        # Set window icon
-        if getattr(sys, 'frozen', False):
-            # Running as compiled executable
-            base_path = os.path.dirname(sys.executable)
-        else:
-            # Running as script
-            base_path = os.path.dirname(os.path.abspath(__file__))
-            
-        icon_path = os.path.join(base_path, 'icon.ico')
-        if os.path.exists(icon_path):
-            self.root.iconbitmap(icon_path)
-        
         # Load configuration
         self.config = self.load_config()
         if not self.config:  # If config loading failed
             self.root.destroy()
             return
         
+        # Detailed progress output is only shown with "debug_logging": true in config.json
+        logging.basicConfig(level=logging.DEBUG if self.config.get('debug_logging') else logging.WARNING,
+                            format="%(levelname)s: %(message)s")
+        
+        # Shared HTTP session so Joplin requests reuse keep-alive connections. joppy
+        # sends all its calls through its module-level session, so that one is
+        # used for the service and token checks too
+        from joppy import client_api
+        self.session = client_api.SESSION
+        self.session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1,
+                                                                     pool_maxsize=JOPLIN_WRITE_WORKERS))
+        
         # Check Joplin service and API token
         if not self.check_joplin_service():
             messagebox.showerror("Error", "Could not connect to Joplin Web Clipper service. Please make sure Joplin is running and the Web Clipper is enabled.")
@@ -162,7 +403,7 @@ class KoboToJoplinApp:
             return
         
         # Initialize Joplin API
-        self.joplin = ClientApi(token=self.config['joplin_api_token'])
+        self.joplin = self.create_joplin_client()
         
         # Setup UI
         self.setup_ui()
@@ -170,13 +411,67 @@ class KoboToJoplinApp:
         # Store selected annotations
         self.selected_annotations = []
         
+        # Inserted row values per tree item, keyed by tree widget path
+        self._tree_rows = {}
+        
+        # Annotation type per tree item, and the selection as last counted
+        self._item_type = {}
+        self._selected_items = set()
+        self._last_selection = None
+        # Number of selected annotations that are (True) and are not (False) markup
+        self._selected_type_counts = Counter()
+        # Timer of a scheduled update_export_button_text, if any
+        self._pending_button_update = None
+        
+        # Folder the last markup image was saved to
+        self._last_save_dir = None
+        
+        # Process pool for markup merging, started on first use
+        self._render_pool = None
+        
+        # Worker thread for device scans and database queries
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # (future, on_done, on_error) of tasks whose results are not yet handled
+        self._pending_tasks = []
+        
+        # EPUB metadata per device, built on the first lookup
+        self._epub_index = {}
+        
+        # Read-only database connections, keyed by database path. They are
+        # opened with check_same_thread=False and only ever read from.
+        self._db_connections = {}
+        atexit.register(self.close_db_connections)
+        # Release the device databases as soon as the window closes. Closing runs
+        # on the worker thread, after any query still using the connections
+        self.root.bind('<Destroy>', lambda event: self.executor.submit(self.close_db_connections)
+                       if event.widget is self.root else None, add='+')
+        
         # Initialize device detection
         self.kobo_devices = []
         self.device_paths = {}
-        
-        # Start periodic device detection
+        self._last_drives = None
+        self._volume_labels = {}
+        self._last_loaded_device = None
+        # Annotation rows of each book in the books list, by item id
+        self._book_annotations = {}
+        
+        # Start device detection. Device change notifications trigger a check
+        # right away, leaving only a slow safety poll; otherwise poll every 5 seconds
         self.detect_kobo_devices()
-        self.root.after(5000, self.periodic_device_detection)  # Check every 5 seconds
+        self.root.bind('<Map>', lambda event: self.check_devices() if event.widget is self.root else None)
+        # The watcher thread may not touch Tk, so it only sets this flag
+        self._device_changed = threading.Event()
+        self._device_watch = watch_device_changes(self._device_changed.set)
+        self.root.after(self.DEVICE_CHANGE_CHECK_INTERVAL, self.check_device_changed)
+        self._device_poll_delay = self.device_poll_interval()
+        self.root.after(self._device_poll_delay, self.periodic_device_detection)
+        
+    def create_joplin_client(self):
+        """Create the Joplin API client for the configured token and Web Clipper address."""
+        from joppy.client_api import ClientApi
+        web_clipper = self.config['web_clipper']
+        return ClientApi(token=self.config['joplin_api_token'],
+                         url=f"{web_clipper['url']}:{web_clipper['port']}")
         
     def check_joplin_service(self):
         """Check if Joplin Web Clipper service is running."""
@@ -185,16 +480,8 @@ class KoboToJoplinApp:
             port = self.config['web_clipper']['port']
             url = f"{base_url}:{port}/ping"
             
-            # First check if the port is open
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            result = sock.connect_ex(('127.0.0.1', port))
-            sock.close()
-            
-            if result != 0:
-                return False
-                
-            # Then check if the service responds
-            response = requests.get(url, timeout=5)
+            # A closed port fails fast with a connection error
+            response = self.session.get(url, timeout=2)
             return response.status_code == 200
         except:
             return False
@@ -205,9 +492,10 @@ class KoboToJoplinApp:
             base_url = self.config['web_clipper']['url']
             port = self.config['web_clipper']['port']
             url = f"{base_url}:{port}/notes"
-            params = {'token': self.config['joplin_api_token']}
+            # Only one note id is needed to tell whether the token works
+            params = {'token': self.config['joplin_api_token'], 'limit': 1, 'fields': 'id'}
             
-            response = requests.get(url, params=params, timeout=5)
+            response = self.session.get(url, params=params, timeout=5)
             return response.status_code == 200
         except:
             return False
@@ -217,8 +505,6 @@ class KoboToJoplinApp:
         config_window = tk.Toplevel(self.root)
         config_window.title("Create Configuration")
         config_window.geometry("500x500")  # Increased height from 400 to 500
-        config_window.transient(self.root)
-        config_window.grab_set()
         
         # Create main frame with padding
         main_frame = ttk.Frame(config_window, padding="10")
@@ -298,9 +584,7 @@ To get your Notebook ID:
                     return
                 
                 # Save to file
-                config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
-                with open(config_path, 'w') as f:
-                    json.dump(config, f, indent=4)
+                save_json(_CONFIG_PATH, config)
                 
                 config_saved[0] = True  # Mark that config was saved
                 config_window.destroy()
@@ -329,12 +613,10 @@ To get your Notebook ID:
         # Configure grid weights
         form_frame.columnconfigure(1, weight=1)
         
-        # Center the window
-        config_window.update_idletasks()
-        width = config_window.winfo_width()
-        height = config_window.winfo_height()
-        x = (config_window.winfo_screenwidth() // 2) - (width // 2)
-        y = (config_window.winfo_screenheight() // 2) - (height // 2)
+        # Center the window; the size is fixed above, so no layout pass is needed
+        width, height = 500, 500
+        x = (config_window.winfo_screenwidth() - width) // 2
+        y = (config_window.winfo_screenheight() - height) // 2
         config_window.geometry(f'{width}x{height}+{x}+{y}')
         
         # Make the window modal
@@ -353,25 +635,16 @@ To get your Notebook ID:
     def load_config(self):
         """Load configuration from config.json or create from default if not exists"""
         try:
-            # Get the directory where the script or executable is located
-            if getattr(sys, 'frozen', False):
-                # Running as compiled executable
-                base_path = os.path.dirname(sys.executable)
-            else:
-                # Running as script
-                base_path = os.path.dirname(os.path.abspath(__file__))
-            
-            config_path = os.path.join(base_path, 'config.json')
+            config_path = _CONFIG_PATH
             
-            print(f"Looking for config at: {config_path}")  # Debug print
+            log.debug("Looking for config at: %s", config_path)
             
             if os.path.exists(config_path):
-                with open(config_path, 'r') as f:
-                    config = json.load(f)
-                    print("Successfully loaded config.json")  # Debug print
-                    return config
+                config = load_json_cached(config_path)
+                log.debug("Successfully loaded config.json")
+                return config
             else:
-                print("No config.json found")  # Debug print
+                log.debug("No config.json found")
                 # Show dialog to create config
                 if not self.create_config_dialog():
                     # If user cancelled, exit
@@ -379,39 +652,163 @@ To get your Notebook ID:
                 # Try loading the config again
                 return self.load_config()
         except Exception as e:
-            print(f"Error loading config: {str(e)}")  # Debug print
+            log.error("Error loading config: %s", e)
             messagebox.showerror("Error", f"Failed to load configuration: {str(e)}")
             self.root.destroy()
             return None
         
-    def detect_kobo_devices(self):
-        """Detect connected Kobo devices and update the dropdown."""
-        self.kobo_devices = []
-        self.device_paths = {}
+    def scan_kobo_drives(self):
+        """Scan the mounted drives for Kobo devices.
+        
+        Runs on the worker thread. Returns a dict of device name to drive,
+        or None if the mounted drives have not changed since the last scan.
+        """
+        # Get all drive letters from the logical drive bitmask
+        mask = win32api.GetLogicalDrives()
+        drives = [drive for i, drive in enumerate(_DRIVE_LETTERS) if mask & (1 << i)]
+        
+        # Nothing was mounted or unmounted since the last check
+        if drives == self._last_drives:
+            return None
+        self._last_drives = drives
         
-        # Get all drive letters
-        drives = [f"{d}:\\" for d in string.ascii_uppercase if os.path.exists(f"{d}:\\")]
+        # Forget labels of drives that have been removed
+        for drive in list(self._volume_labels):
+            if drive not in drives:
+                del self._volume_labels[drive]
         
+        devices = {}
         for drive in drives:
             try:
+                # A Kobo mounts as a local disk; probing network or optical
+                # drives can stall for seconds
+                if win32file.GetDriveType(drive) not in _KOBO_DRIVE_TYPES:
+                    continue
                 # Check for Kobo device signature
                 if os.path.exists(os.path.join(drive, ".kobo")):
-                    # Get device name
-                    device_name = win32api.GetVolumeInformation(drive)[0]
+                    # Get device name, querying the volume only once while it stays mounted
+                    if drive not in self._volume_labels:
+                        self._volume_labels[drive] = win32api.GetVolumeInformation(drive)[0]
+                    device_name = self._volume_labels[drive]
                     if not device_name:
                         device_name = "Kobo Device"
-                    self.kobo_devices.append(device_name)
-                    self.device_paths[device_name] = drive
+                    devices[device_name] = drive
             except:
                 continue
         
+        # Forget EPUB indexes of devices that are no longer mounted
+        for device_path in list(self._epub_index):
+            if device_path not in devices.values():
+                self._epub_index.pop(device_path, None)
+        
+        # Close connections to devices that are no longer mounted
+        self.close_db_connections(lambda db_path: not any(db_path.startswith(drive)
+                                                          for drive in devices.values()))
+        return devices
+        
+    def get_db_connection(self, db_path):
+        """Return the cached read-only connection for a Kobo database, opening it on first use."""
+        conn = self._db_connections.get(db_path)
+        if conn is None:
+            # Open read-only so the database on the device is never modified. Not
+            # immutable: the database can change while mounted (the reader syncs
+            # or another tool writes it), and a reload must see those changes
+            conn = sqlite3.connect(f"file:{pathname2url(db_path)}?mode=ro", uri=True,
+                                   check_same_thread=False, cached_statements=128)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA query_only = ON")
+            conn.execute("PRAGMA cache_size = -40000")
+            conn.execute("PRAGMA temp_store = MEMORY")
+            # Lets large sorts, such as the device-wide annotations query, use helper threads
+            conn.execute("PRAGMA threads = 4")
+            self._db_connections[db_path] = conn
+            if log.isEnabledFor(logging.DEBUG):
+                self.log_query_plans(conn)
+        return conn
+    
+    def log_query_plans(self, conn):
+        """Log how SQLite plans the per-book and per-bookmark lookups, warning about full table scans.
+        
+        The device database is opened read-only, so a missing index can only be
+        reported here, not created.
+        """
+        for name in ('BOOK_ANNOTATIONS_QUERY', 'ANNOTATION_POSITION_QUERY', 'READING_SETTINGS_QUERY'):
+            query = getattr(self, name)
+            try:
+                plan = conn.execute("EXPLAIN QUERY PLAN " + query, (None,) * query.count('?')).fetchall()
+            except sqlite3.Error as e:
+                log.debug("Could not plan %s: %s", name, e)
+                continue
+            for row in plan:
+                detail = row[-1]
+                log.debug("%s: %s", name, detail)
+                if detail.startswith('SCAN') and 'INDEX' not in detail:
+                    log.warning("%s scans a whole table: %s", name, detail)
+    
+    def close_db_connections(self, should_close=None):
+        """Close cached database connections, all of them or those should_close selects."""
+        for db_path in list(self._db_connections):
+            if should_close is None or should_close(db_path):
+                try:
+                    self._db_connections.pop(db_path).close()
+                except Exception:
+                    log.warning("Error closing database connection %s", db_path, exc_info=True)
+        
+    def update_device_list(self, devices):
+        """Update the dropdown with the result of a device scan."""
+        if devices is None or devices == self.device_paths:
+            return
+        
+        self.kobo_devices = list(devices)
+        self.device_paths = devices
+        
         # Update dropdown
         self.device_dropdown['values'] = self.kobo_devices
         if self.kobo_devices:
             self.device_dropdown.set(self.kobo_devices[0])
-            self.load_books()
+            self.load_books(force=True)
         else:
             self.device_dropdown.set("No Kobo device detected")
+            self._last_loaded_device = None
+            
+    def detect_kobo_devices(self):
+        """Detect connected Kobo devices and update the dropdown."""
+        self.run_in_background(self.scan_kobo_drives, self.update_device_list)
+            
+    def run_in_background(self, work, on_done, on_error=None):
+        """Run work() on the worker thread and pass its result to on_done() on the Tk thread."""
+        return self.when_done(self.executor.submit(work), on_done, on_error)
+
+    def when_done(self, future, on_done, on_error=None):
+        """Pass the result of any executor's future to on_done() on the Tk thread."""
+        self._pending_tasks.append((future, on_done, on_error))
+        # All pending tasks share one timer, which only runs while there are any
+        if len(self._pending_tasks) == 1:
+            self.root.after(50, self._check_pending_tasks)
+        return future
+
+    def _check_pending_tasks(self):
+        """Hand finished background tasks to their callbacks, then check again if any remain."""
+        # done() is asked once per task, so one finishing meanwhile cannot be lost
+        finished = []
+        pending = []
+        for task in self._pending_tasks:
+            (finished if task[0].done() else pending).append(task)
+        self._pending_tasks = pending
+        if self._pending_tasks:
+            self.root.after(50, self._check_pending_tasks)
+        
+        # Each callback runs as its own idle event, so one that fails does not drop the rest
+        for future, on_done, on_error in finished:
+            try:
+                result = future.result()
+            except Exception as e:
+                if on_error:
+                    self.root.after_idle(on_error, e)
+                else:
+                    log.error("Background task failed", exc_info=e)
+                continue
+            self.root.after_idle(on_done, result)
             
     def setup_ui(self):
         """Setup the user interface."""
@@ -424,6 +821,7 @@ To get your Notebook ID:
         device_frame.pack(fill=tk.X, pady=5)
         ttk.Label(device_frame, text="Select Kobo Device:").pack(side=tk.LEFT, padx=5)
         self.device_dropdown = ttk.Combobox(device_frame, state="readonly")
+        self.device_dropdown.set("No Kobo device detected")
         self.device_dropdown.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
         self.device_dropdown.bind('<<ComboboxSelected>>', lambda e: self.load_books())
         
@@ -448,7 +846,7 @@ To get your Notebook ID:
         
         # Create books tree view
         self.books_tree = ttk.Treeview(books_tree_frame, 
-                                      columns=('Book', 'Author', 'Annotations'),
+                                      columns=('Book', 'Author', 'Annotations', 'ContentID'),
                                       show='headings',
                                       yscrollcommand=books_scroll_y.set,
                                       xscrollcommand=books_scroll_x.set)
@@ -458,15 +856,18 @@ To get your Notebook ID:
         books_scroll_x.config(command=self.books_tree.xview)
         
         # Define columns for books
-        self.books_tree.heading('Book', text='Book')
-        self.books_tree.heading('Author', text='Author')
-        self.books_tree.heading('Annotations', text='Annotations')
+        self.books_tree.heading('Book', text='Book', command=lambda: self.treeview_sort_column('Book', False, self.books_tree))
+        self.books_tree.heading('Author', text='Author', command=lambda: self.treeview_sort_column('Author', False, self.books_tree))
+        self.books_tree.heading('Annotations', text='Annotations', command=lambda: self.treeview_sort_column('Annotations', False, self.books_tree))
         
         # Set column widths for books
         self.books_tree.column('Book', width=200)
         self.books_tree.column('Author', width=150)
         self.books_tree.column('Annotations', width=100)
         
+        # Hide the ContentID column as it's for internal use
+        self.books_tree.column('ContentID', width=0, stretch=tk.NO)
+        
         self.books_tree.pack(expand=True, fill=tk.BOTH)
         
         # Add selection mode for books
@@ -531,78 +932,126 @@ To get your Notebook ID:
         
         ttk.Button(button_frame, text="Settings", command=self.open_settings).pack(side=tk.LEFT, padx=5)
         
+        # Status messages that need no answer, such as device changes
+        self.status_var = tk.StringVar()
+        ttk.Label(button_frame, textvariable=self.status_var).pack(side=tk.RIGHT, padx=5)
+        self._status_clear = None
+        
         # Bind selection event to update button text
-        self.tree.bind('<<TreeviewSelect>>', self.update_export_button_text)
+        self.tree.bind('<<TreeviewSelect>>', self.schedule_export_button_update)
         
         # Configure grid weights
         main_frame.columnconfigure(0, weight=1)
         main_frame.rowconfigure(0, weight=1)
         
-    def treeview_sort_column(self, col, reverse):
-        # Get all items from the tree
-        items = [(self.tree.set(item, col), item) for item in self.tree.get_children('')]
+    # Sort keys for columns that should not be compared as plain text
+    SORT_KEYS = {
+        'Annotations': int,
+        # Formatted dates sort correctly as text; keep unknown dates first
+        'Date': lambda value: (value != "Unknown Date", value),
+    }
+        
+    def treeview_sort_column(self, col, reverse, tree=None):
+        tree = tree or self.tree
+        
+        # Sort on the values kept when the rows were inserted, compared as text
+        # like Tk would show them; rows the model lacks are read from Tk
+        col_index = tree['columns'].index(col)
+        key = self.SORT_KEYS.get(col, str)
+        row_values = self._tree_rows.get(str(tree), {})
+        items = []
+        for item in tree.get_children(''):
+            values = row_values.get(item)
+            if values is None:
+                values = tree.item(item, 'values')
+            items.append((key(str(values[col_index])), item))
         
         # Sort the items
-        items.sort(reverse=reverse)
+        items.sort(key=lambda entry: entry[0], reverse=reverse)
         
-        # Rearrange items in sorted positions
-        for index, (val, item) in enumerate(items):
-            self.tree.move(item, '', index)
+        # Rearrange items in sorted positions with a single Tcl call
+        tree.set_children('', *(item for val, item in items))
             
         # Toggle the sort direction for the next time
-        self.tree.heading(col, command=lambda: self.treeview_sort_column(col, not reverse))
+        tree.heading(col, command=lambda: self.treeview_sort_column(col, not reverse, tree))
+        
+    # Tcl procedure inserting a list of rows into a Treeview, returning the new item ids
+    _INSERT_ROWS_TCL = ('{widget rows} {set items {}; foreach row $rows '
+                        '{lappend items [$widget insert {} end -values $row]}; return $items}')
+
+    def insert_tree_rows(self, tree, rows):
+        """Append rows to a Treeview in one Tcl call, bypassing the ttk wrapper.
         
-    def load_books(self):
+        Returns the ids of the new items.
+        """
+        rows = list(rows)
+        items = tree.tk.splitlist(tree.tk.call('apply', self._INSERT_ROWS_TCL, tree._w, rows))
+        # Keep the values for sorting, and each annotation's type for
+        # update_export_button_text
+        self._tree_rows.setdefault(str(tree), {}).update(zip(items, rows))
+        if tree is self.tree:
+            self._item_type.update(zip(items, (values[5] for values in rows)))
+        return items
+        
+    def load_books(self, force=False):
         """Load books and their annotation counts from the Kobo database."""
         try:
-            # Clear existing items
-            for item in self.books_tree.get_children():
-                self.books_tree.delete(item)
-            
             # Get selected device
             selected_device = self.device_dropdown.get()
             if not selected_device:
                 return
             
-            # Connect to database
-            db_path = os.path.join(self.device_paths[selected_device], ".kobo", "KoboReader.sqlite")
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-            
-            # Query books and their annotation counts
-            query = """
-                SELECT 
-                    BookContent.Title,
-                    BookContent.Attribution,
-                    COUNT(Bookmark.BookmarkID) as AnnotationCount
-                FROM Bookmark
-                JOIN Content ON Bookmark.ContentID = Content.ContentID
-                JOIN Content as BookContent ON Content.BookID = BookContent.ContentID
-                WHERE (Bookmark.Text IS NOT NULL OR Bookmark.Type = 'markup')
-                GROUP BY BookContent.Title, BookContent.Attribution
-                ORDER BY BookContent.Title
-            """
+            # The books of this device are already shown
+            if selected_device == self._last_loaded_device and not force:
+                return
+            self._last_loaded_device = selected_device
             
-            cursor.execute(query)
-            books = cursor.fetchall()
+            # Clear existing items
+            self.books_tree.delete(*self.books_tree.get_children())
+            self._tree_rows.pop(str(self.books_tree), None)
+            self._book_annotations = {}
             
-            # Add books to tree view
-            for book in books:
-                book_title = book[0] or "Unknown Title"
-                author = book[1] or "Unknown Author"
-                annotation_count = book[2]
-                
-                self.books_tree.insert('', 'end', values=(
-                    book_title,
-                    author,
-                    annotation_count
-                ))
+            db_path = os.path.join(self.device_paths[selected_device], ".kobo", "KoboReader.sqlite")
+        except Exception as e:
+            self.show_load_error("books", e)
+            return
+        
+        def fetch_books():
+            cursor = self.get_db_connection(db_path).cursor()
             
-            conn.close()
+            # Fetch every annotation on the device at once and group them by
+            # book; the books list and its counts follow from the groups
+            cursor.execute(self.DEVICE_ANNOTATIONS_QUERY)
             
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to load books: {str(e)}")
-            print(f"Error details: {str(e)}")
+            # Books are told apart by their ContentID, so two books sharing a
+            # title and author are not merged
+            annotations_by_book = {}
+            for annotation in cursor:
+                book_id = annotation['BookID']
+                book_annotations = annotations_by_book.get(book_id)
+                if book_annotations is None:
+                    book_annotations = annotations_by_book[book_id] = []
+                book_annotations.append(self.annotation_row(annotation['Title'] or "Unknown Title",
+                                                            annotation['Attribution'] or "Unknown Author",
+                                                            annotation))
+            
+            rows = [(book_annotations[0][0], book_annotations[0][1], len(book_annotations), book_id)
+                    for book_id, book_annotations in annotations_by_book.items()]
+            return rows, list(annotations_by_book.values())
+        
+        def show_books(result):
+            rows, annotations = result
+            items = self.insert_tree_rows(self.books_tree, rows)
+            self._book_annotations = dict(zip(items, annotations))
+        
+        # Add books to tree view once the query finishes
+        self.run_in_background(fetch_books, show_books,
+                               lambda e: self.show_load_error("books", e))
+            
+    def show_load_error(self, what, error):
+        """Report a failed books or annotations load."""
+        messagebox.showerror("Error", f"Failed to load {what}: {str(error)}")
+        log.error("Failed to load %s", what, exc_info=error)
             
     def on_book_selected(self, event):
         """Handle book selection and load its annotations."""
@@ -611,18 +1060,30 @@ To get your Notebook ID:
             return
             
         # Clear existing annotations
-        for item in self.tree.get_children():
-            self.tree.delete(item)
-            
-        # Get selected book details
-        values = self.books_tree.item(selected_items[0])['values']
-        book_title = values[0]
-        author = values[1]
+        self.tree.delete(*self.tree.get_children())
+        self._tree_rows.pop(str(self.tree), None)
+        self._item_type.clear()
+        self._selected_items = set()
+        self._last_selection = None
+        self._selected_type_counts.clear()
+            
+        # The annotations were fetched together with the books list
+        rows = self._book_annotations.get(selected_items[0])
+        if rows is not None:
+            self.insert_tree_rows(self.tree, rows)
+            return
+        
+        # Get selected book details; the inserted values keep the ContentID
+        # exactly as the database returned it
+        values = self._tree_rows.get(str(self.books_tree), {}).get(selected_items[0])
+        if values is None:
+            values = self.books_tree.item(selected_items[0], 'values')
+        book_title, author, _, book_id = values
         
         # Load annotations for this book
-        self.load_annotations_for_book(book_title, author)
+        self.load_annotations_for_book(book_id, book_title, author)
         
-    def load_annotations_for_book(self, book_title, author):
+    def load_annotations_for_book(self, book_id, book_title, author):
         """Load annotations for a specific book."""
         try:
             # Get selected device
@@ -630,662 +1091,206 @@ To get your Notebook ID:
             if not selected_device:
                 return
             
-            # Connect to database
             db_path = os.path.join(self.device_paths[selected_device], ".kobo", "KoboReader.sqlite")
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-            
-            # Query annotations for this book
-            query = """
-                SELECT 
-                    Bookmark.Text,
-                    Bookmark.DateCreated,
-                    Bookmark.BookmarkID,
-                    Bookmark.Type,
-                    CASE 
-                        WHEN Bookmark.Type != 'markup' AND Chapter.Title IS NOT NULL THEN Chapter.Title
-                        ELSE ''
-                    END as ChapterTitle,
-                    Bookmark.Color
-                FROM Bookmark
-                JOIN Content ON Bookmark.ContentID = Content.ContentID
-                JOIN Content as BookContent ON Content.BookID = BookContent.ContentID
-                LEFT JOIN Content as Chapter ON Content.ContentID = Chapter.ContentID 
-                    AND Chapter.Title LIKE '%-%'
-                    AND CAST(SUBSTR(Chapter.Title, INSTR(Chapter.Title, '-') + 1) AS INTEGER) IS NOT NULL
-                WHERE BookContent.Title = ? 
-                AND BookContent.Attribution = ?
-                AND (Bookmark.Text IS NOT NULL OR Bookmark.Type = 'markup')
-                ORDER BY Bookmark.DateCreated DESC
-            """
-            
-            cursor.execute(query, (book_title, author))
-            annotations = cursor.fetchall()
-            
-            # Add annotations to tree view
-            for annotation in annotations:
-                text = annotation[0] or ""
-                date_created = annotation[1]
-                bookmark_id = annotation[2]
-                annotation_type = annotation[3]
-                chapter_title = annotation[4]
-                color = annotation[5]
-                
-                # Format date
-                try:
-                    if isinstance(date_created, str):
-                        date_obj = datetime.fromisoformat(date_created)
-                    else:
-                        date_obj = datetime.fromtimestamp(int(date_created))
-                    formatted_date = date_obj.strftime('%Y-%m-%d %H:%M:%S')
-                except (ValueError, TypeError):
-                    formatted_date = "Unknown Date"
-                
-                # For markup annotations, show a placeholder text
-                if annotation_type == 'markup':
-                    text = "[Markup annotation]"
-                
-                # Add to tree view
-                self.tree.insert('', 'end', values=(
-                    book_title,
-                    author,
-                    text,
-                    formatted_date,
-                    bookmark_id,
-                    annotation_type,
-                    color
-                ))
-            
-            conn.close()
-            
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to load annotations: {str(e)}")
-            print(f"Error details: {str(e)}")
+            self.show_load_error("annotations", e)
+            return
+        
+        # Add annotations to tree view once the query finishes
+        self.run_in_background(lambda: self.fetch_annotations(db_path, book_id, book_title, author),
+                               lambda rows: self.insert_tree_rows(self.tree, rows),
+                               lambda e: self.show_load_error("annotations", e))
+
+    # Every annotation on the device with its book, by book and then newest first
+    DEVICE_ANNOTATIONS_QUERY = """
+        SELECT 
+            Content.BookID,
+            BookContent.Title,
+            BookContent.Attribution,
+            Bookmark.Text,
+            Bookmark.DateCreated,
+            Bookmark.BookmarkID,
+            Bookmark.Type,
+            Bookmark.Color
+        FROM Bookmark
+        JOIN Content ON Bookmark.ContentID = Content.ContentID
+        JOIN Content as BookContent ON Content.BookID = BookContent.ContentID
+        WHERE (Bookmark.Text IS NOT NULL OR Bookmark.Type = 'markup')
+        ORDER BY BookContent.Title, BookContent.Attribution, Content.BookID, Bookmark.DateCreated DESC
+    """
+
+    # Annotations of one book by its ContentID, newest first
+    BOOK_ANNOTATIONS_QUERY = """
+        SELECT 
+            Bookmark.Text,
+            Bookmark.DateCreated,
+            Bookmark.BookmarkID,
+            Bookmark.Type,
+            Bookmark.Color
+        FROM Bookmark
+        JOIN Content ON Bookmark.ContentID = Content.ContentID
+        WHERE Content.BookID = ?
+        AND (Bookmark.Text IS NOT NULL OR Bookmark.Type = 'markup')
+        ORDER BY Bookmark.DateCreated DESC
+    """
+
+    def fetch_annotations(self, db_path, book_id, book_title, author):
+        """Query and format the annotations of a book. Runs on the worker thread."""
+        cursor = self.get_db_connection(db_path).cursor()
+        
+        # Query annotations for this book
+        cursor.execute(self.BOOK_ANNOTATIONS_QUERY, (book_id,))
+        
+        return [self.annotation_row(book_title, author, annotation) for annotation in cursor]
+
+    def annotation_row(self, book_title, author, annotation):
+        """Format an annotation query row as the values of an annotations list row."""
+        text = annotation['Text'] or ""
+        annotation_type = annotation['Type']
+        
+        # For markup annotations, show a placeholder text
+        if annotation_type == 'markup':
+            text = "[Markup annotation]"
+        
+        return (
+            book_title,
+            author,
+            text,
+            format_kobo_date(annotation['DateCreated']),
+            annotation['BookmarkID'],
+            annotation_type,
+            annotation['Color']
+        )
+
+    def build_epub_index(self, device_path):
+        """Collect (path, title, author) for every EPUB in the book folders of a device."""
+        # Common paths where Kobo stores books
+        possible_paths = [
+            os.path.join(device_path, "Digital Editions"),
+            os.path.join(device_path, "Books"),
+            os.path.join(device_path, "eBooks")
+        ]
+        
+        index = []
+        for base_path in possible_paths:
+            if not os.path.exists(base_path):
+                continue
             
-    def locate_epub_file(self, book_title, author):
-        """Locate the EPUB file for a given book on the Kobo device."""
+            # Walk through all subdirectories
+            for root, dirs, files in os.walk(base_path):
+                for file in files:
+                    if file.lower().endswith('.epub'):
+                        epub_path = os.path.join(root, file)
+                        try:
+                            epub_title, epub_author = read_epub_metadata(epub_path)
+                        except Exception as e:
+                            log.warning("Error reading EPUB file %s: %s", file, e)
+                            continue
+                        if epub_title:
+                            index.append((epub_path, epub_title, epub_author))
+        return index
+        
+    def locate_epub_file(self, device_path, book_title, author):
+        """Locate the EPUB file for a given book on the Kobo device at device_path.
+        
+        Reads no widgets, so it can run on the worker thread.
+        """
         try:
-            selected_device = self.device_dropdown.get()
-            if not selected_device:
-                return None
-
-            # Common paths where Kobo stores books
-            possible_paths = [
-                os.path.join(self.device_paths[selected_device], "Digital Editions"),
-                os.path.join(self.device_paths[selected_device], "Books"),
-                os.path.join(self.device_paths[selected_device], "eBooks")
-            ]
-
-            # Search for the EPUB file
-            for base_path in possible_paths:
-                if not os.path.exists(base_path):
-                    continue
-
-                # Walk through all subdirectories
-                for root, dirs, files in os.walk(base_path):
-                    for file in files:
-                        if file.lower().endswith('.epub'):
-                            # Try to match the book by title and author
-                            try:
-                                epub_path = os.path.join(root, file)
-                                book = epub.read_epub(epub_path)
-                                
-                                # Get book metadata
-                                metadata = book.get_metadata('DC', 'title')
-                                if not metadata:
-                                    continue
-                                    
-                                epub_title = metadata[0][0]
-                                epub_author = book.get_metadata('DC', 'creator')
-                                epub_author = epub_author[0][0] if epub_author else ""
-                                
-                                # Compare titles and authors (case-insensitive)
-                                if (book_title.lower() in epub_title.lower() or 
-                                    epub_title.lower() in book_title.lower()) and \
-                                   (not author or not epub_author or 
-                                    author.lower() in epub_author.lower() or 
-                                    epub_author.lower() in author.lower()):
-                                    return epub_path
-                            except Exception as e:
-                                print(f"Error reading EPUB file {file}: {str(e)}")
-                                continue
+            # Scan the device once and reuse the index for later lookups
+            index = self._epub_index.get(device_path)
+            if index is None:
+                index = self.build_epub_index(device_path)
+                self._epub_index[device_path] = index
+            
+            for epub_path, epub_title, epub_author in index:
+                # Compare titles and authors (case-insensitive)
+                if (book_title.lower() in epub_title.lower() or 
+                    epub_title.lower() in book_title.lower()) and \
+                   (not author or not epub_author or 
+                    author.lower() in epub_author.lower() or 
+                    epub_author.lower() in author.lower()):
+                    return epub_path
 
             return None
         except Exception as e:
-            print(f"Error locating EPUB file: {str(e)}")
+            log.warning("Error locating EPUB file: %s", e)
             return None
 
+    # Reading settings of the book a piece of content belongs to
+    READING_SETTINGS_QUERY = """
+        SELECT 
+            cs.ReadingFontFamily,
+            cs.ReadingFontSize,
+            cs.ZoomFactor
+        FROM content_settings cs
+        JOIN Bookmark b ON cs.ContentID = b.VolumeID
+        WHERE b.ContentID = ?
+    """
+    
+    # Fallback when there is no content_settings row
+    READING_SETTINGS_FALLBACK_QUERY = """
+        SELECT 
+            ReadingFontFamily,
+            ReadingFontSize,
+            ZoomFactor
+        FROM Content
+        WHERE ContentID = ?
+    """
+
     def get_reading_settings(self, db_path, content_id):
         """Get reading settings from the content_settings table."""
         try:
-            print(f"\n=== Reading Settings Debug ===")
-            print(f"Looking up settings for ContentID: {content_id}")
-            print(f"Database path: {db_path}")
-            
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-            
-            # Get reading settings from content_settings table using VolumeID
-            query = """
-                SELECT 
-                    cs.ReadingFontFamily,
-                    cs.ReadingFontSize,
-                    cs.ZoomFactor
-                FROM content_settings cs
-                JOIN Bookmark b ON cs.ContentID = b.VolumeID
-                WHERE b.ContentID = ?
-            """
+            # The cached connection keeps both statements prepared between calls
+            conn = self.get_db_connection(db_path)
             
-            cursor.execute(query, (content_id,))
-            result = cursor.fetchone()
+            result = conn.execute(self.READING_SETTINGS_QUERY, (content_id,)).fetchone()
+            if not result:
+                # Try to get settings from Content table as fallback
+                result = conn.execute(self.READING_SETTINGS_FALLBACK_QUERY, (content_id,)).fetchone()
             
             if result:
-                settings = {
+                return {
                     'font_family': result[0] or 'Arial',
                     'font_size': result[1] or 16,
                     'zoom_factor': result[2] or 1.0
                 }
-                print(f"Found settings:")
-                print(f"  Font Family: {settings['font_family']}")
-                print(f"  Font Size: {settings['font_size']}")
-                print(f"  Zoom Factor: {settings['zoom_factor']}")
-                return settings
-            else:
-                print("No settings found in content_settings table")
-                # Try to get settings from Content table as fallback
-                fallback_query = """
-                    SELECT 
-                        ReadingFontFamily,
-                        ReadingFontSize,
-                        ZoomFactor
-                    FROM Content
-                    WHERE ContentID = ?
-                """
-                cursor.execute(fallback_query, (content_id,))
-                fallback_result = cursor.fetchone()
-                
-                if fallback_result:
-                    settings = {
-                        'font_family': fallback_result[0] or 'Arial',
-                        'font_size': fallback_result[1] or 16,
-                        'zoom_factor': fallback_result[2] or 1.0
-                    }
-                    print(f"Found fallback settings from Content table:")
-                    print(f"  Font Family: {settings['font_family']}")
-                    print(f"  Font Size: {settings['font_size']}")
-                    print(f"  Zoom Factor: {settings['zoom_factor']}")
-                    return settings
-                else:
-                    print("No settings found in Content table either")
-                    return None
+            return None
             
         except Exception as e:
-            print(f"Error getting reading settings: {str(e)}")
+            log.warning("Error getting reading settings: %s", e)
             return None
-        finally:
-            if conn:
-                conn.close()
 
-    def get_page_image(self, epub_path, content_id, position_info=None):
-        """Extract a specific page from an EPUB file as an image."""
-        try:
-            print(f"\n=== Page Image Generation Debug ===")
-            print(f"Content ID: {content_id}")
-            print(f"Position Info: {position_info}")
-            print(f"EPUB Path: {epub_path}")
-            
-            # Read the EPUB file
-            book = epub.read_epub(epub_path)
-            
-            # Determine if this is a KEPUB
-            is_kepub = False
-            for format_config in self.chapter_formats['kepub_formats']:
-                if format_config['path_marker'] in content_id:
-                    is_kepub = True
-                    break
-            
-            print(f"Is KEPUB: {is_kepub}")
-            
-            # Parse the content ID to get the chapter and position
-            try:
-                # Check for KEPUB formats first
-                for format_config in self.chapter_formats['kepub_formats']:
-                    if format_config['path_marker'] in content_id:
-                        print(f"\nProcessing KEPUB content ID: {content_id}")
-                        # Extract the chapter number using the configured pattern
-                        chapter_match = re.search(format_config['chapter_pattern'], content_id)
-                        if chapter_match:
-                            chapter_num = int(chapter_match.group(1))
-                            position = 0  # Position is not available in KEPUB format
-                            print(f"Found chapter number: {chapter_num}")
-                            
-                            # For KEPUB, we need to find the specific chapter file
-                            chapter_path = None
-                            print("Searching for chapter file...")
-                            
-                            # Get all document items and sort them by their href
-                            doc_items = []
-                            print("Available chapters in EPUB:")
-                            for item in book.get_items():
-                                if item.get_type() == ebooklib.ITEM_DOCUMENT:
-                                    href = item.get_name()
-                                    print(f"Found document: {href}")
-                                    # Check if the href matches any KEPUB format pattern
-                                    if any(re.search(fmt['chapter_pattern'], href, re.IGNORECASE) for fmt in self.chapter_formats['kepub_formats']):
-                                        doc_items.append(item)
-                                        print(f"Added KEPUB chapter: {href}")
-                            
-                            print(f"Total KEPUB chapters found: {len(doc_items)}")
-                            
-                            # Sort by the chapter number in the filename
-                            def get_chapter_number(item):
-                                href = item.get_name()
-                                for fmt in self.chapter_formats['kepub_formats']:
-                                    match = re.search(fmt['chapter_pattern'], href, re.IGNORECASE)
-                                    if match:
-                                        return int(match.group(1))
-                                print(f"No chapter number found in {href}")
-                                return 0
-                            
-                            doc_items.sort(key=get_chapter_number)
-                            
-                            # Find the chapter by its number
-                            chapter = None
-                            print(f"Looking for chapter with number {chapter_num}")
-                            for item in doc_items:
-                                href = item.get_name()
-                                for fmt in self.chapter_formats['kepub_formats']:
-                                    match = re.search(fmt['chapter_pattern'], href, re.IGNORECASE)
-                                    if match:
-                                        current_num = int(match.group(1))
-                                        print(f"Checking chapter {current_num}")
-                                        if current_num == chapter_num:
-                                            chapter = item
-                                            print(f"Found matching chapter: {href}")
-                                            break
-                                if chapter:
-                                    break
-                            
-                            if chapter:
-                                print(f"Found chapter: {chapter.get_name()}")
-                            else:
-                                print(f"Could not find chapter with number {chapter_num}")
-                                return None
-                                
-                            print(f"Successfully loaded chapter content")
-                            break
-                else:
-                    # Handle regular EPUB format
-                    print(f"\nProcessing regular EPUB content ID: {content_id}")
-                    
-                    # Special handling for OEBPS/part format
-                    if 'OEBPS/part' in content_id:
-                        chapter_match = re.search(r'part(\d+)\.xhtml', content_id)
-                        if chapter_match:
-                            chapter_num = int(chapter_match.group(1))
-                            position = 0
-                            print(f"Found OEBPS chapter number: {chapter_num}")
-                            
-                            # Get all document items
-                            doc_items = []
-                            print("Searching for OEBPS chapter files...")
-                            for item in book.get_items():
-                                if item.get_type() == ebooklib.ITEM_DOCUMENT:
-                                    href = item.get_name()
-                                    print(f"Found document: {href}")
-                                    if 'OEBPS/part' in href:
-                                        doc_items.append(item)
-                                        print(f"Added OEBPS chapter: {href}")
-                            
-                            print(f"Total OEBPS chapters found: {len(doc_items)}")
-                            
-                            # Sort by the chapter number in the filename
-                            def get_chapter_number(item):
-                                href = item.get_name()
-                                match = re.search(r'part(\d+)\.xhtml', href)
-                                if match:
-                                    return int(match.group(1))
-                                print(f"No chapter number found in {href}")
-                                return 0
-                            
-                            doc_items.sort(key=get_chapter_number)
-                            
-                            # Find the chapter by its number
-                            chapter = None
-                            print(f"Looking for OEBPS chapter with number {chapter_num}")
-                            for item in doc_items:
-                                href = item.get_name()
-                                match = re.search(r'part(\d+)\.xhtml', href)
-                                if match:
-                                    current_num = int(match.group(1))
-                                    print(f"Checking chapter {current_num}")
-                                    if current_num == chapter_num:
-                                        chapter = item
-                                        print(f"Found matching chapter: {href}")
-                                        break
-                            
-                            if chapter:
-                                print(f"Found chapter: {chapter.get_name()}")
-                            else:
-                                print(f"Could not find OEBPS chapter with number {chapter_num}")
-                                return None
-                            
-                            print(f"Successfully loaded OEBPS chapter content")
-                        else:
-                            print(f"Could not parse OEBPS chapter number from content ID")
-                            return None
-                    else:
-                        # Handle other EPUB formats
-                        for format_config in self.chapter_formats['epub_formats']:
-                            if format_config['path_marker'] in content_id:
-                                parts = content_id.split(format_config['path_marker'])
-                                if len(parts) > 1:
-                                    chapter_info = parts[1]
-                                    chapter_match = re.search(format_config['chapter_pattern'], chapter_info)
-                                    if chapter_match:
-                                        chapter_num = int(chapter_match.group(1))
-                                        position = int(chapter_match.group(2)) if chapter_match.group(2) else 0
-                                        
-                                        # Get all document items and sort them
-                                        doc_items = [item for item in book.get_items() if item.get_type() == ebooklib.ITEM_DOCUMENT]
-                                        doc_items.sort(key=lambda x: x.get_name())
-                                        
-                                        # Find the chapter by its position in the sorted list
-                                        if 0 <= chapter_num - 1 < len(doc_items):
-                                            chapter = doc_items[chapter_num - 1]
-                                            print(f"Found chapter: {chapter.get_name()}")
-                                        else:
-                                            print(f"Chapter number {chapter_num} out of range")
-                                            return None
-                                        break
-            except (ValueError, IndexError) as e:
-                print(f"Invalid content ID format: {content_id}, error: {str(e)}")
-                return None
-            
-            if not chapter:
-                print("No chapter found for the given content ID")
-                return None
-            
-            # Get the chapter content as HTML
-            print("\nGetting chapter content as HTML...")
-            html_content = chapter.get_content().decode('utf-8')
-            print(f"HTML content length: {len(html_content)}")
-            
-            # Parse HTML with BeautifulSoup
-            print("Parsing HTML with BeautifulSoup...")
-            soup = BeautifulSoup(html_content, 'html.parser')
-            
-            # If we have container paths, try to find the exact elements
-            if position_info and position_info.get('start_container'):
-                print("\nLooking for annotation elements...")
-                print(f"Start container path: {position_info['start_container']}")
-                print(f"End container path: {position_info['end_container']}")
-                
-                # Parse the container paths
-                start_path = position_info['start_container'].split('/')
-                end_path = position_info['end_container'].split('/')
-                
-                # Find the elements
-                start_element = soup
-                end_element = soup
-                
-                for tag in start_path:
-                    if tag:
-                        start_element = start_element.find(tag)
-                        if not start_element:
-                            break
-                
-                for tag in end_path:
-                    if tag:
-                        end_element = end_element.find(tag)
-                        if not end_element:
-                            break
-                
-                if start_element and end_element:
-                    print("Found annotation elements")
-                    # Add a class to mark the annotated text
-                    start_element['class'] = start_element.get('class', []) + ['annotation-start']
-                    end_element['class'] = end_element.get('class', []) + ['annotation-end']
-            
-            # Extract and inline CSS
-            styles = soup.find_all('style')
-            css_text = ''
-            for style in styles:
-                css_text += style.string + '\n'
-            
-            # Add annotation highlighting CSS
-            css_text += """
-            .annotation-start, .annotation-end {
-                background-color: yellow;
-                opacity: 0.3;
-            }
-            """
-            
-            # Create a temporary directory for assets
-            with tempfile.TemporaryDirectory() as temp_dir:
-                # Process images in the HTML
-                print("Processing images in HTML...")
-                for img in soup.find_all('img'):
-                    if img.get('src'):
-                        # Get the image data from the EPUB
-                        img_path = img['src']
-                        img_item = book.get_item_with_href(img_path)
-                        if img_item:
-                            # Convert image to base64
-                            img_data = img_item.get_content()
-                            img_b64 = base64.b64encode(img_data).decode('utf-8')
-                            img['src'] = f"data:image/png;base64,{img_b64}"
-                
-                # Get reading settings
-                reading_settings = self.get_reading_settings(os.path.join(self.device_paths[self.device_dropdown.get()], ".kobo", "KoboReader.sqlite"), content_id)
-                
-                if not reading_settings:
-                    reading_settings = {
-                        'font_family': 'Arial',
-                        'font_size': 16,
-                        'zoom_factor': 1.0
-                    }
-                    print("Using default reading settings:")
-                else:
-                    print("Using reading settings from database:")
-                print(f"  Font family: {reading_settings['font_family']}")
-                print(f"  Font size: {reading_settings['font_size']}")
-                print(f"  Zoom factor: {reading_settings['zoom_factor']}")
-                
-                # Calculate page dimensions
-                base_width = 800
-                base_height = 1800
-                zoom_factor = reading_settings['zoom_factor']
-                
-                # Calculate scaled dimensions
-                page_width = int(base_width * zoom_factor)
-                page_height = int(base_height * zoom_factor)
-                
-                # Get font settings
-                font_family = reading_settings['font_family']
-                font_size = reading_settings['font_size']
-                
-                # Create HTML document
-                print("\nCreating HTML document...")
-                html_doc = f"""
-                <!DOCTYPE html>
-                <html>
-                <head>
-                    <meta charset="utf-8">
-                    <meta name="viewport" content="width={page_width}">
-                    <style>
-                        @page {{
-                            size: {page_width}px {page_height}px;
-                            margin: 0;
-                        }}
-                        html {{
-                            width: {page_width}px;
-                            margin: 0;
-                            padding: 0;
-                        }}
-                        body {{
-                            margin: 0;
-                            padding: {int(20 * zoom_factor)}px;
-                            font-family: {font_family}, sans-serif;
-                            font-size: {font_size}px;
-                            line-height: 1.4;
-                            color: #333;
-                            width: {page_width - int(40 * zoom_factor)}px;
-                            background: transparent;
-                            transform: scale({zoom_factor});
-                            transform-origin: top left;
-                        }}
-                        img {{
-                            max-width: 100%;
-                            height: auto;
-                        }}
-                        p {{
-                            margin: 0 0 1em 0;
-                        }}
-                        h1, h2, h3, h4, h5, h6 {{
-                            margin: 1em 0 0.5em 0;
-                            font-family: {font_family}, sans-serif;
-                            font-size: {int(font_size * 1.2)}px;
-                        }}
-                        {css_text}
-                    </style>
-                </head>
-                <body>
-                    <div id="content">
-                        {soup.body.decode_contents() if soup.body else soup.decode_contents()}
-                    </div>
-                </body>
-                </html>
-                """
-                
-                # Calculate the vertical offset for cropping
-                if position_info and position_info.get('ChapterProgress') is not None:
-                    print(f"\n=== Page Position Calculation ===")
-                    print(f"Raw chapter_progress from DB: {position_info['ChapterProgress']}")
-                    
-                    # Convert chapter_progress to float if it's a string
-                    if isinstance(position_info['ChapterProgress'], str):
-                        try:
-                            chapter_progress = float(position_info['ChapterProgress'])
-                        except ValueError:
-                            chapter_progress = 0.0
-                    else:
-                        chapter_progress = position_info['ChapterProgress']
-                    
-                    # Ensure chapter_progress is between 0 and 1
-                    chapter_progress = max(0.0, min(1.0, chapter_progress))
-                    print(f"Normalized chapter_progress: {chapter_progress}")
-                    
-                    # Calculate total height of the chapter content
-                    options = {
-                        'format': 'png',
-                        'encoding': 'UTF-8',
-                        'width': page_width,
-                        'height': 10000,  # Use a large height to get full content
-                        'enable-local-file-access': None,
-                        'disable-smart-width': None,
-                        'quality': 100,
-                        'quiet': None,
-                        'log-level': 'info'
-                    }
-                    
-                    # Create temporary files
-                    html_path = os.path.join(temp_dir, 'page.html')
-                    full_png_path = os.path.join(temp_dir, 'full_page.png')
-                    
-                    # Write HTML to file
-                    with open(html_path, 'w', encoding='utf-8') as f:
-                        f.write(html_doc)
-                    
-                    # Convert HTML to PNG to get full height
-                    imgkit.from_file(html_path, full_png_path, options=options)
-                    full_img = Image.open(full_png_path)
-                    total_height = full_img.height
-                    print(f"Total chapter height: {total_height}px")
-                    
-                    # Calculate target position based on chapter progress and container paths
-                    if position_info.get('start_container'):
-                        # If we have container paths, try to adjust the position
-                        print("Using container paths for positioning")
-                        # Find the start element in the rendered image
-                        # This is approximate since we can't get exact pixel positions
-                        # We'll use the chapter progress as a fallback
-                        target_position = int(chapter_progress * total_height)
-                    else:
-                        # Use chapter progress as the main positioning method
-                        print("Using chapter progress for positioning")
-                        target_position = int(chapter_progress * total_height)
-                    
-                    print(f"Target position in chapter: {target_position}px")
-                    
-                    # Calculate which page this position falls on
-                    page_number = target_position // page_height
-                    position_in_page = target_position % page_height
-                    print(f"Page number in chapter: {page_number}")
-                    print(f"Position within page: {position_in_page}px")
-                    
-                    # Calculate crop position to show the target position in the middle of the viewport
-                    crop_y = max(0, target_position - (page_height // 2))
-                    print(f"Initial crop_y position: {crop_y}px")
-                    
-                    # Adjust crop_y to ensure we don't go beyond the total height
-                    max_crop_y = max(0, total_height - page_height)
-                    crop_y = min(crop_y, max_crop_y)
-                    print(f"Final adjusted crop_y position: {crop_y}px")
-                    
-                    # Crop the full image to get the specific page
-                    crop_box = (0, crop_y, page_width, min(crop_y + page_height, total_height))
-                    print(f"Cropping image with box: {crop_box}")
-                    img = full_img.crop(crop_box)
-                    print(f"Cropped image size: {img.size}")
-                    
-                    # Clean up temporary files
-                    try:
-                        os.unlink(full_png_path)
-                    except Exception as e:
-                        print(f"Warning: Could not delete temporary file {full_png_path}: {str(e)}")
-                    
-                    return img, crop_y, total_height
-                else:
-                    print("\nNo position information available, rendering first page")
-                    # If no position info, just render the first page
-                    options = {
-                        'format': 'png',
-                        'encoding': 'UTF-8',
-                        'width': page_width,
-                        'height': page_height,
-                        'enable-local-file-access': None,
-                        'disable-smart-width': None,
-                        'quality': 100,
-                        'quiet': None,
-                        'log-level': 'info'
-                    }
-                    
-                    # Create temporary files
-                    html_path = os.path.join(temp_dir, 'page.html')
-                    png_path = os.path.join(temp_dir, 'page.png')
-                    
-                    # Write HTML to file
-                    with open(html_path, 'w', encoding='utf-8') as f:
-                        f.write(html_doc)
-                    
-                    # Convert HTML to PNG
-                    imgkit.from_file(html_path, png_path, options=options)
-                    img = Image.open(png_path)
-                    
-                    # Clean up temporary files
-                    try:
-                        os.unlink(png_path)
-                    except Exception as e:
-                        print(f"Warning: Could not delete temporary file {png_path}: {str(e)}")
-                    
-                    return img, 0, page_height
-                
-        except Exception as e:
-            print(f"Error extracting page from EPUB: {str(e)}")
-            # Return a placeholder image with error message
-            img = Image.new('RGB', (page_width, page_height), color='white')
-            return img, 0, page_height
+    def setup_chapter_patterns(self):
+        """Compile the chapter formats' patterns used to parse content IDs."""
+        # Compile the chapter patterns once, paired with their format
+        self.kepub_formats = [(fmt, re.compile(fmt['chapter_pattern']))
+                              for fmt in self.chapter_formats['kepub_formats']]
+        self.epub_formats = [(fmt, re.compile(fmt['chapter_pattern']))
+                             for fmt in self.chapter_formats['epub_formats']]
+        
+        # Every path marker, matched in one pass over a content ID. The lookahead
+        # lets markers that overlap each other all be found.
+        markers = {fmt['path_marker'] for fmt, _ in self.kepub_formats + self.epub_formats}
+        self._path_marker_re = re.compile('(?=(' + '|'.join(
+            re.escape(marker) for marker in sorted(markers, key=len, reverse=True)) + '))')
+
+    def formats_in(self, content_id):
+        """Return the KEPUB and EPUB (format, pattern) pairs whose path marker occurs in content_id.
+        
+        Both lists keep the configuration order.
+        """
+        present = set(self._path_marker_re.findall(content_id))
+        if not present:
+            return [], []
+        return ([entry for entry in self.kepub_formats if entry[0]['path_marker'] in present],
+                [entry for entry in self.epub_formats if entry[0]['path_marker'] in present])
+
+    def get_render_pool(self):
+        """Return the process pool used for merging markups, starting it on first use."""
+        if self._render_pool is None:
+            self._render_pool = ProcessPoolExecutor(max_workers=min(MARKUP_MERGE_WORKERS, os.cpu_count() or 1))
+            atexit.register(self._render_pool.shutdown)
+        return self._render_pool
 
     def position_markup(self, markup_svg, page_image, position_info):
         """
@@ -1295,138 +1300,147 @@ To get your Notebook ID:
             # Get page dimensions
             page_width, page_height = page_image.size
             
-            # Read and parse SVG
-            svg_content = markup_svg.read()
-            svg_tree = ET.fromstring(svg_content)
+            # Read SVG
+            svg_content = strip_svg(markup_svg.read())
             
-            # Set viewBox to match page dimensions
-            svg_tree.set('viewBox', f'0 0 {page_width} {page_height}')
-            svg_tree.set('width', str(page_width))
-            svg_tree.set('height', str(page_height))
-            
-            # Convert to PNG
-            modified_svg = ET.tostring(svg_tree)
-            png_data = cairosvg.svg2png(bytestring=modified_svg)
-            
-            # Create transparent layer with markup
-            markup_image = Image.open(io.BytesIO(png_data))
+            # Create transparent layer with markup, viewBox matching the page
+            markup_image = rasterize_svg(resize_svg(svg_content, 0, 0, page_width, page_height))
             
             # Combine with page
-            result = Image.alpha_composite(page_image.convert('RGBA'), markup_image)
+            result = page_image.convert('RGB')
+            result.paste(markup_image, (0, 0), markup_image)
             
             return result
             
         except Exception as e:
-            print(f"Error positioning markup: {str(e)}")
+            log.warning("Error positioning markup: %s", e)
             return page_image
 
-    def merge_markup_with_page(self, markup_path, page_image):
-        """Merge markup SVG with page image from JPG."""
+    @staticmethod
+    def merge_markup_with_page(markup_path, page_image, max_size=None):
+        """Merge markup SVG with page image from JPG.
+        
+        With max_size, a JPEG page is decoded at a reduced scale that still
+        covers max_size, and the markup is rasterized to match.
+        
+        An RGB page_image is drawn on in place and returned, so pass a freshly
+        opened image, or a copy of one that is used again afterwards.
+        """
         try:
-            print(f"\n=== Markup Merge Debug ===")
-            print(f"Markup path: {markup_path}")
-            print(f"Page image size: {page_image.size}")
+            log.debug("Merging markup %s with a page of size %s", markup_path, page_image.size)
             
             # Read SVG file
             with open(markup_path, 'rb') as f:
-                svg_content = f.read()
-            
-            # Parse SVG
-            svg_tree = ET.fromstring(svg_content)
+                svg_content = strip_svg(f.read())
             
             # Get page dimensions
             page_width, page_height = page_image.size
+            if max_size:
+                # Let libjpeg scale down while decoding; the markup keeps full-page coordinates
+                page_image.draft('RGB', max_size)
+            
+            # Create transparent layer, with the viewBox matching the page
+            log.debug("Rasterizing SVG...")
+            markup_image = rasterize_svg(resize_svg(svg_content, 0, 0, page_width, page_height,
+                                                    page_image.size))
+            log.debug("Markup image size: %s", markup_image.size)
+            
+            # Combine images. The page is opaque, so blending the markup in
+            # through its own alpha matches alpha_composite without RGBA copies.
+            # The page is not copied first: decoding at a reduced scale with
+            # draft() only works on an image that has not been loaded yet
+            log.debug("Combining images...")
+            result = page_image if page_image.mode == 'RGB' else page_image.convert('RGB')
+            markup_bbox = markup_image.getchannel('A').getbbox()
+            if markup_bbox:
+                markup_area = markup_image.crop(markup_bbox)
+                result.paste(markup_area, markup_bbox[:2], markup_area)
+            
+            log.debug("Merge completed successfully")
+            return result
             
-            # Set viewBox to match page dimensions
-            svg_tree.set('viewBox', f'0 0 {page_width} {page_height}')
-            svg_tree.set('width', str(page_width))
-            svg_tree.set('height', str(page_height))
-            
-            # Convert to PNG
-            print("Converting SVG to PNG...")
-            modified_svg = ET.tostring(svg_tree)
-            png_data = cairosvg.svg2png(bytestring=modified_svg)
-            
-            # Create transparent layer
-            markup_image = Image.open(io.BytesIO(png_data))
-            print(f"Markup image size: {markup_image.size}")
-            
-            # Ensure both images are in RGBA mode
-            page_rgba = page_image.convert('RGBA')
-            markup_rgba = markup_image.convert('RGBA')
-            
-            # Combine images
-            print("Combining images...")
-            result = Image.alpha_composite(page_rgba, markup_rgba)
-            
-            print("Merge completed successfully")
-            return result.convert('RGB')
-            
-        except Exception as e:
-            print(f"Error merging markup with page: {str(e)}")
+        except Exception:
+            log.exception("Error merging markup with page")
             return None
 
+    # Position details of a single bookmark
+    ANNOTATION_POSITION_QUERY = """
+        SELECT 
+            Bookmark.ContentID,
+            Bookmark.Annotation,
+            Bookmark.Text,
+            Content.ContentID as EpubPath,
+            Bookmark.ChapterProgress,
+            Bookmark.VolumeId,
+            Bookmark.StartContainerPath,
+            Bookmark.EndContainerPath,
+            Bookmark.StartOffset,
+            Bookmark.EndOffset
+        FROM Bookmark
+        JOIN Content ON Bookmark.ContentID = Content.ContentID
+        WHERE Bookmark.BookmarkID = ?
+    """
+
     def get_annotation_position(self, db_path, bookmark_id):
         """Get the exact position information for an annotation from the Kobo database."""
         try:
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-            
-            # Query to get position information
-            query = """
-                SELECT 
-                    Bookmark.ContentID,
-                    Bookmark.Annotation,
-                    Bookmark.Text,
-                    Content.ContentID as EpubPath,
-                    Bookmark.ChapterProgress,
-                    Bookmark.VolumeId,
-                    Bookmark.StartContainerPath,
-                    Bookmark.EndContainerPath,
-                    Bookmark.StartOffset,
-                    Bookmark.EndOffset
-                FROM Bookmark
-                JOIN Content ON Bookmark.ContentID = Content.ContentID
-                WHERE Bookmark.BookmarkID = ?
-            """
+            cursor = self.get_db_connection(db_path).cursor()
             
-            cursor.execute(query, (bookmark_id,))
+            cursor.execute(self.ANNOTATION_POSITION_QUERY, (bookmark_id,))
             result = cursor.fetchone()
             
             if result:
-                content_id = result[0]
-                annotation = result[1]
-                text = result[2]
-                epub_path = result[3]
-                ChapterProgress = result[4]
-                volume_id = result[5]
-                start_container = result[6]
-                end_container = result[7]
-                start_offset = result[8]
-                end_offset = result[9]
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("Database values: %s", dict(result))
                 
-                print(f"Database values:")  # Debug log
-                print(f"  ContentID: {content_id}")
-                print(f"  ChapterProgress: {ChapterProgress}")
-                print(f"  VolumeId: {volume_id}")
-                print(f"  StartContainerPath: {start_container}")
-                print(f"  EndContainerPath: {end_container}")
-                print(f"  StartOffset: {start_offset}")
-                print(f"  EndOffset: {end_offset}")
+                content_id = result['ContentID']
+                annotation = result['Annotation']
+                text = result['Text']
+                ChapterProgress = result['ChapterProgress']
+                start_container = result['StartContainerPath']
+                end_container = result['EndContainerPath']
+                start_offset = result['StartOffset']
+                end_offset = result['EndOffset']
                 
                 # Parse the content ID to get position
                 try:
+                    matching_kepub, matching_epub = self.formats_in(content_id)
+                    
                     # Check for KEPUB formats first
-                    for format_config in self.chapter_formats['kepub_formats']:
-                        if format_config['path_marker'] in content_id:
-                            # Extract the chapter number using the configured pattern
-                            chapter_match = re.search(format_config['chapter_pattern'], content_id)
+                    for format_config, chapter_re in matching_kepub:
+                        # Extract the chapter number using the configured pattern
+                        chapter_match = chapter_re.search(content_id)
+                        if chapter_match:
+                            chapter_num = int(chapter_match.group(1))
+                            position = 0  # Position is not available in KEPUB format
+                            
+                            # Extract the base EPUB path
+                            epub_path = content_id.split(format_config['epub_path_split'])[0]
+                            
+                            return {
+                                'chapter_num': chapter_num,
+                                'position': position,
+                                'content_id': content_id,
+                                'epub_path': epub_path,
+                                'annotation': annotation,
+                                'text': text,
+                                'ChapterProgress': ChapterProgress,
+                                'start_container': start_container,
+                                'end_container': end_container,
+                                'start_offset': start_offset,
+                                'end_offset': end_offset
+                            }
+                    
+                    # If not a KEPUB format, check EPUB formats
+                    for format_config, chapter_re in matching_epub:
+                        parts = content_id.split(format_config['path_marker'])
+                        if len(parts) > 1:
+                            chapter_info = parts[1]
+                            chapter_match = chapter_re.search(chapter_info)
                             if chapter_match:
                                 chapter_num = int(chapter_match.group(1))
-                                position = 0  # Position is not available in KEPUB format
-                                
-                                # Extract the base EPUB path
-                                epub_path = content_id.split(format_config['epub_path_split'])[0]
+                                position = int(chapter_match.group(2)) if chapter_match.group(2) else 0
+                                epub_path = parts[0]
                                 
                                 return {
                                     'chapter_num': chapter_num,
@@ -1435,38 +1449,12 @@ To get your Notebook ID:
                                     'epub_path': epub_path,
                                     'annotation': annotation,
                                     'text': text,
-                                    'ChapterProgress': ChapterProgress,
-                                    'start_container': start_container,
-                                    'end_container': end_container,
-                                    'start_offset': start_offset,
-                                    'end_offset': end_offset
+                                    'ChapterProgress': ChapterProgress
                                 }
                     
-                    # If not a KEPUB format, check EPUB formats
-                    for format_config in self.chapter_formats['epub_formats']:
-                        if format_config['path_marker'] in content_id:
-                            parts = content_id.split(format_config['path_marker'])
-                            if len(parts) > 1:
-                                chapter_info = parts[1]
-                                chapter_match = re.search(format_config['chapter_pattern'], chapter_info)
-                                if chapter_match:
-                                    chapter_num = int(chapter_match.group(1))
-                                    position = int(chapter_match.group(2)) if chapter_match.group(2) else 0
-                                    epub_path = parts[0]
-                                    
-                                    return {
-                                        'chapter_num': chapter_num,
-                                        'position': position,
-                                        'content_id': content_id,
-                                        'epub_path': epub_path,
-                                        'annotation': annotation,
-                                        'text': text,
-                                        'ChapterProgress': ChapterProgress
-                                    }
-                    
                     # Special handling for OEBPS/partXXXX.xhtml format
                     if 'OEBPS/part' in content_id:
-                        chapter_match = re.search(r'part(\d+)\.xhtml', content_id)
+                        chapter_match = _OEBPS_PART_RE.search(content_id)
                         if chapter_match:
                             chapter_num = int(chapter_match.group(1))
                             position = 0
@@ -1482,37 +1470,35 @@ To get your Notebook ID:
                                 'ChapterProgress': ChapterProgress
                             }
                     
-                    print(f"Could not match content ID to any known format: {content_id}")
+                    log.warning("Could not match content ID to any known format: %s", content_id)
                     return None
                     
                 except (ValueError, IndexError) as e:
-                    print(f"Error parsing content ID: {content_id}, error: {str(e)}")
+                    log.warning("Error parsing content ID: %s, error: %s", content_id, e)
                     return None
                     
             return None
             
         except Exception as e:
-            print(f"Error getting annotation position: {str(e)}")
+            log.warning("Error getting annotation position: %s", e)
             return None
-        finally:
-            if conn:
-                conn.close()
 
-    def preview_combined_image(self, image, bookmark_id):
-        """Show a preview window for the combined image."""
-        print(f"Creating preview window for bookmark {bookmark_id}...")  # Debug log
+    def preview_combined_image(self, image, bookmark_id, book_title, author, load_full_image=None):
+        """Show a preview window for the combined image of a bookmark in the given book.
+        
+        If image is a reduced preview, load_full_image() returns the full-resolution
+        image used for exporting and saving. It is called on the worker thread.
+        """
+        if load_full_image is None:
+            load_full_image = lambda: image
+        from PIL import Image
+        
+        log.debug("Creating preview window for bookmark %s...", bookmark_id)
         preview_window = tk.Toplevel(self.root)
         preview_window.title(f"Preview - Bookmark {bookmark_id}")
         
         # Set window icon
-        if getattr(sys, 'frozen', False):
-            # Running as compiled executable
-            base_path = os.path.dirname(sys.executable)
-        else:
-            # Running as script
-            base_path = os.path.dirname(os.path.abspath(__file__))
-            
-        icon_path = os.path.join(base_path, 'icon.ico')
+        icon_path = os.path.join(_BASE_PATH, 'icon.ico')
         if os.path.exists(icon_path):
             preview_window.iconbitmap(icon_path)
         
@@ -1566,88 +1552,85 @@ To get your Notebook ID:
         button_frame.pack(fill=tk.X, side=tk.TOP, pady=(0, window_padding))
         
         def export_and_close():
-            print(f"Exporting bookmark {bookmark_id} to Joplin...")  # Debug log
-            try:
-                # Get book title and author from the database
-                db_path = os.path.join(self.device_paths[self.device_dropdown.get()], ".kobo", "KoboReader.sqlite")
-                conn = sqlite3.connect(db_path)
-                cursor = conn.cursor()
-                
-                # Query to get book title and author
-                query = """
-                    SELECT 
-                        BookContent.Title,
-                        BookContent.Attribution
-                    FROM Bookmark
-                    JOIN Content ON Bookmark.ContentID = Content.ContentID
-                    JOIN Content as BookContent ON Content.BookID = BookContent.ContentID
-                    WHERE Bookmark.BookmarkID = ?
-                """
-                
-                cursor.execute(query, (bookmark_id,))
-                result = cursor.fetchone()
-                conn.close()
-                
-                if not result:
-                    raise Exception("Could not find book information")
-                
-                book_title = result[0] or "Unknown Title"
-                author = result[1] or "Unknown Author"
-                
+            log.debug("Exporting bookmark %s to Joplin...", bookmark_id)
+            # Block further clicks while the upload runs on the worker thread
+            for button in (export_button, save_button):
+                button.state(['disabled'])
+            
+            def upload():
                 # Save the image to a temporary file
                 temp_path = os.path.join(tempfile.gettempdir(), f"preview_{bookmark_id}.png")
-                print(f"Saving image to: {temp_path}")  # Debug log
-                image.save(temp_path)
-                
-                print("Adding image as resource to Joplin...")  # Debug log
-                # Add the image as a resource
-                resource_id = self.joplin.add_resource(
-                    filename=temp_path,
-                    title=f"Markup with Page {bookmark_id}"
-                )
-                
-                print("Creating note in Joplin...")  # Debug log
-                # Create a new note with the image using the same title format as other annotations
-                self.joplin.add_note(
-                    title=f"{book_title} - {author}",
-                    body=f"![Markup with Page](:/{resource_id})",
-                    parent_id=self.config['notebook_id']
-                )
-                
-                print("Export completed successfully")  # Debug log
+                try:
+                    log.debug("Saving image to: %s", temp_path)
+                    full_image = load_full_image()
+                    if full_image is None:
+                        raise Exception("Could not merge markup with page")
+                    full_image.save(temp_path)
+                    
+                    log.debug("Adding image as resource to Joplin...")
+                    # Add the image as a resource
+                    resource_id = self.joplin.add_resource(
+                        filename=temp_path,
+                        title=f"Markup with Page {bookmark_id}"
+                    )
+                    
+                    log.debug("Creating note in Joplin...")
+                    # Create a new note with the image using the same title format as other annotations
+                    self.joplin.add_note(
+                        title=f"{book_title} - {author}",
+                        body=f"![Markup with Page](:/{resource_id})",
+                        parent_id=self.config['notebook_id']
+                    )
+                finally:
+                    # Clean up temporary file
+                    if os.path.exists(temp_path):
+                        log.debug("Cleaning up temporary file: %s", temp_path)
+                        os.remove(temp_path)
+            
+            def on_uploaded(result):
+                log.debug("Export completed successfully")
                 preview_window.destroy()
-                
-            except Exception as e:
-                print(f"Error during export: {str(e)}")  # Debug log
+            
+            def on_error(e):
+                log.error("Error during export: %s", e)
                 preview_window.destroy()
                 # Show error message in the main window
-                self.root.after(100, lambda: messagebox.showerror("Error", f"Failed to export to Joplin: {str(e)}"))
-            finally:
-                # Clean up temporary file
-                if os.path.exists(temp_path):
-                    print(f"Cleaning up temporary file: {temp_path}")  # Debug log
-                    os.remove(temp_path)
+                messagebox.showerror("Error", f"Failed to export to Joplin: {str(e)}")
+            
+            self.run_in_background(upload, on_uploaded, on_error)
         
         def save_image():
             """Save the image to a file."""
-            try:
-                # Get the default filename from the bookmark ID
-                default_filename = f"annotation_{bookmark_id}.png"
-                
-                # Ask user for save location
-                file_path = filedialog.asksaveasfilename(
-                    defaultextension=".png",
-                    filetypes=[("PNG files", "*.png"), ("All files", "*.*")],
-                    initialfile=default_filename
-                )
-                
-                if file_path:  # If user didn't cancel
-                    print(f"Saving image to: {file_path}")  # Debug log
-                    image.save(file_path)
-                    messagebox.showinfo("Success", "Image saved successfully!")
-            except Exception as e:
-                print(f"Error saving image: {str(e)}")  # Debug log
+            # Get the default filename from the bookmark ID
+            default_filename = f"annotation_{bookmark_id}.png"
+            
+            # Ask user for save location
+            file_path = filedialog.asksaveasfilename(
+                defaultextension=".png",
+                filetypes=[("PNG files", "*.png"), ("All files", "*.*")],
+                initialfile=default_filename,
+                initialdir=self._last_save_dir,
+                parent=preview_window
+            )
+            if not file_path:  # User cancelled
+                return
+            # Start the next save where this one went
+            self._last_save_dir = os.path.dirname(file_path)
+            
+            def save():
+                log.debug("Saving image to: %s", file_path)
+                full_image = load_full_image()
+                if full_image is None:
+                    raise Exception("Could not merge markup with page")
+                full_image.save(file_path)
+            
+            def on_error(e):
+                log.error("Error saving image: %s", e)
                 messagebox.showerror("Error", f"Failed to save image: {str(e)}")
+            
+            self.run_in_background(save, lambda result: messagebox.showinfo("Success", "Image saved successfully!",
+                                                                            parent=preview_window),
+                                   on_error)
         
         # Create buttons with more padding
         export_button = ttk.Button(button_frame, text="Export to Joplin", 
@@ -1666,19 +1649,29 @@ To get your Notebook ID:
         image_frame = ttk.Frame(main_frame)
         image_frame.pack(fill=tk.BOTH, expand=True)
         
-        # Convert PIL image to PhotoImage and resize
-        resized_image = image.resize((scaled_width, scaled_height), Image.Resampling.LANCZOS)
-        photo = ImageTk.PhotoImage(resized_image)
+        # Convert PIL image to PhotoImage and resize. Bilinear is enough on
+        # screen; reducing_gap first shrinks by a whole factor with a cheap box filter
+        resized_image = image.resize((scaled_width, scaled_height), Image.Resampling.BILINEAR,
+                                     reducing_gap=2.0)
+        if resized_image.mode != 'RGB':
+            resized_image = resized_image.convert('RGB')
+        # PPM is a format Tk reads natively, which skips ImageTk's per-pixel copy
+        buffer = io.BytesIO()
+        resized_image.save(buffer, 'PPM')
+        photo = tk.PhotoImage(master=preview_window, data=buffer.getvalue(), format='PPM')
         
         # Add image to frame
         image_label = ttk.Label(image_frame, image=photo)
         image_label.image = photo  # Keep a reference
         image_label.pack(fill=tk.BOTH, expand=True)
         
-        print("Preview window created successfully")  # Debug log
+        log.debug("Preview window created successfully")
+        return preview_window
 
     def export_to_joplin(self):
         """Export annotations to Joplin"""
+        from PIL import Image
+        
         if not self.config.get('joplin_api_token') or not self.config.get('notebook_id'):
             messagebox.showerror("Error", "Joplin API token or notebook ID not configured")
             return False
@@ -1690,70 +1683,134 @@ To get your Notebook ID:
                 messagebox.showwarning("Warning", "Please select annotations to export")
                 return False
 
-            # Check if we have markup annotations
-            has_markup = False
-            for item in selected_items:
-                values = self.tree.item(item)['values']
-                if values[5] == 'markup':  # Type is in the 6th column
-                    has_markup = True
-                    break
+            # Check if we have markup annotations, stopping at the first one
+            item_type = self._item_type
+            has_markup = any(item_type.get(item) == 'markup' for item in selected_items)
 
             # If we have markup annotations, handle them differently
             if has_markup:
-                # Process each markup annotation
+                # Only markup rows need their values fetched from Tk
+                markups = []
                 for item in selected_items:
-                    values = self.tree.item(item)['values']
-                    if values[5] == 'markup':
-                        bookmark_id = values[4]
-                        book_title = values[0]
-                        author = values[1]
-                        print(f"Debug - Processing markup for bookmark {bookmark_id}")  # Debug print
+                    if item_type.get(item) == 'markup':
+                        values = self.tree.item(item)['values']
+                        markups.append((values[4], values[0], values[1]))
+                markup_dir = os.path.join(self.device_paths[self.device_dropdown.get()], ".kobo", "markups")
+                
+                # The preview never shows more than this, see preview_combined_image
+                preview_size = (int(self.root.winfo_screenwidth() * 0.9),
+                                int(self.root.winfo_screenheight() * 0.75))
+                
+                def find_markup_files():
+                    """Return the markups whose files are on the device. Runs on the worker thread."""
+                    # The markups folder is listed once instead of checking two files per markup
+                    try:
+                        with os.scandir(markup_dir) as entries:
+                            markup_files = {entry.name for entry in entries}
+                    except OSError:
+                        markup_files = set()
+                    
+                    candidates = []
+                    for bookmark_id, book_title, author in markups:
+                        log.debug("Processing markup for bookmark %s", bookmark_id)
                         
                         # Get the markup file path
-                        markup_path = os.path.join(self.device_paths[self.device_dropdown.get()], ".kobo", "markups", f"{bookmark_id}.svg")
-                        print(f"Debug - Markup path: {markup_path}")  # Debug print
+                        markup_path = os.path.join(markup_dir, f"{bookmark_id}.svg")
+                        log.debug("Markup path: %s", markup_path)
                         
-                        if os.path.exists(markup_path):
-                            print("Debug - Markup file exists")  # Debug print
+                        if f"{bookmark_id}.svg" in markup_files:
+                            log.debug("Markup file exists")
                             # Get the page image path from the same directory as the markup
-                            page_path = os.path.join(os.path.dirname(markup_path), f"{bookmark_id}.jpg")
-                            print(f"Debug - Page path: {page_path}")  # Debug print
+                            page_path = os.path.join(markup_dir, f"{bookmark_id}.jpg")
+                            log.debug("Page path: %s", page_path)
                             
-                            if os.path.exists(page_path):
-                                print("Debug - Page file exists")  # Debug print
-                                # Load the page image
-                                page_image = Image.open(page_path)
-                                print("Debug - Loaded page image")  # Debug print
-                                
-                                # Merge markup with page
-                                combined_image = self.merge_markup_with_page(markup_path, page_image)
-                                if combined_image:
-                                    print("Debug - Created combined image")  # Debug print
-                                    # Show preview
-                                    self.preview_combined_image(combined_image, bookmark_id)
-                                    return True
-                                else:
-                                    print("Debug - Failed to merge markup with page")  # Debug print
+                            if f"{bookmark_id}.jpg" in markup_files:
+                                log.debug("Page file exists")
+                                candidates.append((markup_path, page_path, bookmark_id,
+                                                   book_title or "Unknown Title",
+                                                   author or "Unknown Author"))
                             else:
-                                print("Debug - Page file does not exist")  # Debug print
+                                log.debug("Page file does not exist")
                         else:
-                            print("Debug - Markup file does not exist")  # Debug print
-                messagebox.showerror("Error", "Could not generate preview image")
-                return False
+                            log.debug("Markup file does not exist")
+                    return candidates
+                
+                def merge_markups(candidates):
+                    """Merge every markup at preview size, then show the previews."""
+                    if not candidates:
+                        show_previews([])
+                        return
+                    jobs = [(markup_path, page_path, preview_size)
+                            for markup_path, page_path, *_ in candidates]
+                    # Rasterizing is CPU bound, so several markups are spread over
+                    # processes. Their futures are polled from Tk rather than waited
+                    # for, so the worker thread stays free for other tasks
+                    if len(jobs) > 1:
+                        pool = self.get_render_pool()
+                        futures = [pool.submit(_merge_markup_one, job) for job in jobs]
+                    else:
+                        futures = [self.executor.submit(_merge_markup_one, jobs[0])]
+                    
+                    combined_images = [None] * len(futures)
+                    remaining = [len(futures)]
+                    
+                    def on_merged(index, combined_image):
+                        combined_images[index] = combined_image
+                        remaining[0] -= 1
+                        if not remaining[0]:
+                            show_previews(collect_merged(candidates, combined_images))
+                    
+                    def on_merge_failed(index, e):
+                        log.error("Error merging markup with page", exc_info=e)
+                        on_merged(index, None)
+                    
+                    for index, future in enumerate(futures):
+                        self.when_done(future, functools.partial(on_merged, index),
+                                       functools.partial(on_merge_failed, index))
+                
+                def collect_merged(candidates, combined_images):
+                    """Pair the merged previews with their bookmarks, skipping failed merges."""
+                    merged = []
+                    for (markup_path, page_path, bookmark_id, book_title, author), combined_image \
+                            in zip(candidates, combined_images):
+                        if combined_image is None:
+                            log.debug("Failed to merge markup with page")
+                            continue
+                        log.debug("Created combined image")
+                        # Export and Save Image use the page at full resolution
+                        def load_full_image(markup_path=markup_path, page_path=page_path):
+                            # The page is opened for this merge alone, which draws on it in place
+                            return self.merge_markup_with_page(markup_path, Image.open(page_path))
+                        merged.append((combined_image, bookmark_id, book_title, author, load_full_image))
+                    return merged
+                
+                def show_previews(merged):
+                    if not merged:
+                        messagebox.showerror("Error", "Could not generate preview image")
+                        return
+                    # Previews are modal, so the next one opens when the current one closes
+                    preview_window = self.preview_combined_image(*merged[0])
+                    if len(merged) > 1:
+                        def on_destroy(event):
+                            if event.widget is preview_window:
+                                self.root.after_idle(show_previews, merged[1:])
+                        preview_window.bind('<Destroy>', on_destroy)
+                
+                self.run_in_background(find_markup_files, merge_markups,
+                                       lambda e: messagebox.showerror("Error", f"Could not generate preview image: {str(e)}"))
+                return True
 
             # For non-markup annotations, continue with normal export
             # Load highlight colors
             try:
-                with open('highlight_colors.json', 'r') as f:
-                    highlight_colors = json.load(f)
+                highlight_colors = load_json_cached('highlight_colors.json')
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to load highlight colors: {str(e)}")
                 return False
 
             # Load template
             try:
-                with open('annotation_template.md', 'r', encoding='utf-8') as f:
-                    template = f.read()
+                template = load_text_cached('annotation_template.md', encoding='utf-8')
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to load template: {str(e)}")
                 return False
@@ -1761,6 +1818,10 @@ To get your Notebook ID:
             # Group annotations by book
             annotations_by_book = {}
             for item in selected_items:
+                # Skip markup annotations before fetching their values from Tk
+                if item_type.get(item) == 'markup':
+                    continue
+
                 values = self.tree.item(item)['values']
                 book_title = values[0]
                 author = values[1]
@@ -1770,10 +1831,6 @@ To get your Notebook ID:
                 annotation_type = values[5]
                 color = values[6]  # Get the color value
 
-                # Skip markup annotations
-                if annotation_type == 'markup':
-                    continue
-
                 if (book_title, author) not in annotations_by_book:
                     annotations_by_book[(book_title, author)] = []
                 annotations_by_book[(book_title, author)].append({
@@ -1784,106 +1841,156 @@ To get your Notebook ID:
                     'color': color
                 })
 
-            # Process each book's annotations
+            # Build each book's note content
+            notes_to_write = []
             for (book_title, author), annotations in annotations_by_book.items():
-                # Create note content using template
-                note_content = []
+                # Create a timestamped note section per annotation using the template
+                note_items = []
                 for annotation in annotations:
                     # Get highlight colors for this annotation type
                     color_index = str(annotation['color'])  # Use the color value directly
-                    print(f"Debug - Color index: {color_index}")  # Debug print
+                    log.debug("Color index: %s", color_index)
                     colors = highlight_colors.get(color_index, {
                         'background': '#FFFFFF',
                         'foreground': '#000000'
                     })
-                    print(f"Debug - Colors: {colors}")  # Debug print
+                    log.debug("Colors: %s", colors)
 
                     # Format the annotation using the template
-                    anno_content = template
-                    anno_content = anno_content.replace('%chapter_title%', 'Chapter')  # TODO: Get actual chapter
-                    anno_content = anno_content.replace('%anno_date%', annotation['date'].split()[0])
-                    anno_content = anno_content.replace('%anno_time%', annotation['date'].split()[1])
-                    anno_content = anno_content.replace('%anno_page%', '')  # TODO: Get actual page
-                    anno_content = anno_content.replace('%anno_type%', annotation['type'])
-                    anno_content = anno_content.replace('%highlight_background%', colors['background'])
-                    anno_content = anno_content.replace('%highlight_foreground%', colors['foreground'])
-                    anno_content = anno_content.replace('%anno_text%', annotation['text'])
-
-                    note_content.append(anno_content)
-
-                # Create or update the note in Joplin
-                note_title = f"{book_title} - {author}"
-                notes = self.joplin.search_all(query=note_title, type_="note")
-
-                # Only consider the note if it's in our configured notebook
-                existing_note = None
-                for note in notes:
-                    if note.parent_id == self.config['notebook_id']:
-                        existing_note = note
-                        break
+                    date_parts = annotation['date'].split()
+                    anno_content = fill_template(template, {
+                        'chapter_title': 'Chapter',  # TODO: Get actual chapter
+                        'anno_date': date_parts[0],
+                        'anno_time': date_parts[1],
+                        'anno_page': '',  # TODO: Get actual page
+                        'anno_type': annotation['type'],
+                        'highlight_background': colors['background'],
+                        'highlight_foreground': colors['foreground'],
+                        'anno_text': annotation['text'],
+                    })
 
-                try:
-                    if existing_note:
-                        # Update existing note
-                        existing_content = existing_note.body or ""  # Use empty string if body is None
-                        new_content = ''.join(note_content)  # Join without any separator
-                        # Remove any trailing whitespace from existing content
-                        existing_content = existing_content.rstrip()
-                        # Add new content without separator
-                        self.joplin.modify_note(
-                            id_=existing_note.id,
-                            body=existing_content + new_content
-                        )
-                    else:
-                        # Create new note
-                        self.joplin.add_note(
-                            title=note_title,
-                            body=''.join(note_content),  # Join without any separator
-                            parent_id=self.config['notebook_id']
-                        )
-                except Exception as e:
-                    messagebox.showerror("Error", f"Failed to export note: {str(e)}")
-                    continue
+                    note_items.append((annotation['date'], anno_content))
+
+                notes_to_write.append((f"{book_title} - {author}", note_items))
 
-            messagebox.showinfo("Success", "Annotations exported successfully!")
+            def write_notes():
+                """Create or update the notes in Joplin. Runs on the worker thread."""
+                # List the configured notebook's notes once instead of searching per book.
+                # Joplin returns 10 items per page unless asked for its maximum of 100
+                existing_notes = {}
+                for note in self.joplin.get_all_notes(notebook_id=self.config['notebook_id'],
+                                                      fields='id,title', limit=100):
+                    existing_notes.setdefault(note.title, note)
+
+                def write_note(note):
+                    note_title, note_items = note
+                    existing_note = existing_notes.get(note_title)
+
+                    try:
+                        if existing_note:
+                            # Update existing note
+                            body = self.joplin.get_note(existing_note.id, fields='body').body
+                            existing_content = body or ""  # Use empty string if body is None
+                            # Remove any trailing whitespace from existing content
+                            existing_content = existing_content.rstrip()
+                            # Merge the new sections into the note in chronological order
+                            self.joplin.modify_note(
+                                id_=existing_note.id,
+                                body=self.merge_contents(existing_content, note_items)
+                            )
+                        else:
+                            # Create new note
+                            self.joplin.add_note(
+                                title=note_title,
+                                body=self.merge_contents("", note_items),
+                                parent_id=self.config['notebook_id']
+                            )
+                    except Exception as e:
+                        return f"{note_title}: {str(e)}"
+                    return None
+
+                # Joplin has no batch endpoint, so the round trips of
+                # different books' notes are overlapped instead. joppy sends
+                # every call through its module-level session, so the writers
+                # use that one session concurrently. This is safe only because
+                # nothing changes the session (adapters, headers, cookies)
+                # during an export and its urllib3 pool is thread-safe; keep it
+                # that way, and keep the worker count within the pool size
+                if len(notes_to_write) > 1:
+                    with ThreadPoolExecutor(max_workers=min(JOPLIN_WRITE_WORKERS, len(notes_to_write))) as pool:
+                        results = list(pool.map(write_note, notes_to_write))
+                else:
+                    results = [write_note(note) for note in notes_to_write]
+                return [error for error in results if error]
+
+            def on_written(errors):
+                if errors:
+                    messagebox.showerror("Error", "Failed to export note:\n" + "\n".join(errors))
+                else:
+                    messagebox.showinfo("Success", f"Exported annotations to {len(notes_to_write)} note(s) successfully!")
+
+            self.run_in_background(write_notes, on_written,
+                                   lambda e: messagebox.showerror("Error", f"Failed to export to Joplin: {str(e)}"))
             return True
 
         except Exception as e:
             messagebox.showerror("Error", f"Failed to export to Joplin: {str(e)}")
             return False
 
-    def insert_content_in_order(self, existing_content, new_content, timestamp):
-        """Insert new content in chronological order within the existing note content."""
-        if not existing_content:
-            return f"Timestamp: {timestamp}\n{new_content}"
-            
-        # Split the existing content into sections
-        sections = existing_content.split('\n\n---\n\n')
+    def split_note_sections(self, existing_content):
+        """Split note content into (epoch, section) pairs sorted by timestamp.
         
-        # Create a list of (timestamp, content) tuples
+        merge_contents uses this to parse a note once however many sections
+        are added to it. Sections without a readable timestamp, such as notes
+        exported before sections were timestamped, stay at the top.
+        """
         content_with_timestamps = []
-        
-        for section in sections:
+        for section in (existing_content or "").split(NOTE_SECTION_SEPARATOR):
             if not section:
                 continue
-                
-            # Try to find a timestamp in the section
-            section_timestamp = None
-            for line in section.split('\n'):
-                if line and line.startswith('Timestamp: '):
-                    section_timestamp = line.replace('Timestamp: ', '')
-                    break
-            
-            content_with_timestamps.append((section_timestamp or "Unknown Date", section))
-        
-        # Add the new content with its timestamp
-        content_with_timestamps.append((timestamp, f"Timestamp: {timestamp}\n{new_content}"))
+            section_epoch = None
+            if section.startswith(_SECTION_TS_PREFIX):
+                # Sections written by merge_contents lead with their epoch
+                try:
+                    start = len(_SECTION_TS_PREFIX)
+                    section_epoch = int(section[start:section.index(' ', start)])
+                except ValueError:
+                    pass
+            else:
+                # Older sections only have the Timestamp line
+                timestamp_match = _TIMESTAMP_RE.search(section)
+                if timestamp_match:
+                    section_epoch = timestamp_epoch(timestamp_match.group(1))
+            content_with_timestamps.append((float('-inf') if section_epoch is None else section_epoch, section))
         
         # Sort by timestamp
         content_with_timestamps.sort(key=lambda x: x[0])
+        return content_with_timestamps
+
+    def format_note_section(self, content, epoch):
+        """Return a note section for content, led by its epoch when it is known."""
+        if epoch is None:
+            return content
+        return f"{_SECTION_TS_PREFIX}{epoch} -->\n{content}"
+
+    def insert_content_in_order(self, existing_content, new_content, timestamp):
+        """Insert new content in chronological order within the existing note content."""
+        return self.merge_contents(existing_content, [(timestamp, new_content)])
+
+    def merge_contents(self, existing_body, new_items):
+        """Merge (timestamp, content) items into a note body in chronological order.
         
-        # Rebuild the content
-        return '\n\n---\n\n'.join(content[1] for content in content_with_timestamps)
+        The body is split and joined once however many items are merged. New
+        items without a readable timestamp go at the end.
+        """
+        sections = self.split_note_sections(existing_body)
+        for timestamp, content in new_items:
+            epoch = timestamp_epoch(timestamp)
+            sections.append((float('inf') if epoch is None else epoch,
+                             self.format_note_section(content.rstrip(), epoch)))
+        # The sort is stable, so new items follow existing sections with the same timestamp
+        sections.sort(key=lambda x: x[0])
+        return NOTE_SECTION_SEPARATOR.join(content[1] for content in sections)
 
     def open_settings(self):
         """Open the settings dialog."""
@@ -1928,20 +2035,22 @@ To get your Notebook ID:
         def save_settings():
             """Save the settings and update the configuration."""
             try:
-                self.config['joplin_api_token'] = api_token_var.get()
-                self.config['notebook_id'] = notebook_id_var.get()
-                self.config['web_clipper'] = {
+                # Build the new settings apart from self.config, which is also the
+                # cached parse of config.json, so a failed save changes neither
+                config = dict(self.config)
+                config['joplin_api_token'] = api_token_var.get()
+                config['notebook_id'] = notebook_id_var.get()
+                config['web_clipper'] = {
                     'url': web_clipper_url_var.get(),
                     'port': int(web_clipper_port_var.get())
                 }
                 
                 # Save to file
-                config_path = os.path.join(os.path.dirname(__file__), 'config.json')
-                with open(config_path, 'w') as f:
-                    json.dump(self.config, f, indent=4)
+                save_json(_CONFIG_PATH, config)
+                self.config = config
                 
                 # Reinitialize Joplin API with new token
-                self.joplin = ClientApi(token=self.config['joplin_api_token'])
+                self.joplin = self.create_joplin_client()
                 
                 settings_window.destroy()
                 messagebox.showinfo("Success", "Settings saved successfully!")
@@ -1957,74 +2066,134 @@ To get your Notebook ID:
     def load_chapter_formats(self):
         """Load chapter formats configuration from JSON file."""
         try:
-            # Get the directory where the script or executable is located
-            if getattr(sys, 'frozen', False):
-                # Running as compiled executable
-                base_path = os.path.dirname(sys.executable)
-            else:
-                # Running as script
-                base_path = os.path.dirname(os.path.abspath(__file__))
-            
-            config_path = os.path.join(base_path, 'chapter_formats.json')
-            
-            if os.path.exists(config_path):
-                with open(config_path, 'r') as f:
-                    return json.load(f)
-            else:
-                print(f"Chapter formats configuration not found at: {config_path}")
-                return None
-        except Exception as e:
-            print(f"Error loading chapter formats: {str(e)}")
+            return load_json_cached(_CHAPTER_FORMATS_PATH)
+        except FileNotFoundError:
+            log.warning("Chapter formats configuration not found at: %s", _CHAPTER_FORMATS_PATH)
+            return None
+        except (OSError, ValueError) as e:
+            # Both json and orjson decode errors are ValueErrors
+            log.warning("Error loading chapter formats: %s", e)
             return None
 
+    def schedule_export_button_update(self, event=None):
+        """Update the export button once a burst of selection changes has settled."""
+        if self._pending_button_update is not None:
+            self.root.after_cancel(self._pending_button_update)
+        self._pending_button_update = self.root.after(50, self.update_export_button_text)
+
     def update_export_button_text(self, event=None):
         """Update the export button text based on selected annotation type."""
-        selected_items = self.tree.selection()
-        if not selected_items:
-            self.export_button.configure(text="Export to Joplin", state="normal")
+        self._pending_button_update = None
+        # Nothing to do if the selection is the same as last time
+        selection = self.tree.selection()
+        if selection == self._last_selection:
             return
-            
-        # Check if we have mixed annotation types
-        has_markup = False
-        has_other = False
-        
-        for item in selected_items:
-            values = self.tree.item(item)['values']
-            if values:
-                if values[5] == 'markup':  # Type is in the 6th column
-                    has_markup = True
-                else:
-                    has_other = True
-                    
-                # If we have both types, disable the button
-                if has_markup and has_other:
-                    self.export_button.configure(text="Export to Joplin", state="disabled")
-                    return
-        
+        self._last_selection = selection
+        
+        # Only the change in selection is counted, using the types recorded at insert
+        selected_items = set(selection)
+        for item in selected_items - self._selected_items:
+            self._selected_type_counts[self._item_type.get(item) == 'markup'] += 1
+        for item in self._selected_items - selected_items:
+            self._selected_type_counts[self._item_type.get(item) == 'markup'] -= 1
+        self._selected_items = selected_items
+        
+        has_markup = self._selected_type_counts[True] > 0
+        has_other = self._selected_type_counts[False] > 0
+        
+        # If we have both types, disable the button
+        if has_markup and has_other:
+            self.export_button.configure(text="Export to Joplin", state="disabled")
         # If we only have markup, show Preview Image
-        if has_markup:
+        elif has_markup:
             self.export_button.configure(text="Preview Image", state="normal")
         # If we only have other types, show Export to Joplin
         else:
             self.export_button.configure(text="Export to Joplin", state="normal")
 
-    def periodic_device_detection(self):
-        """Periodically check for Kobo devices."""
+    def show_status(self, message, duration=4000):
+        """Show message in the status bar for duration milliseconds."""
+        if self._status_clear is not None:
+            self.root.after_cancel(self._status_clear)
+        self.status_var.set(message)
+        self._status_clear = self.root.after(duration, self.status_var.set, '')
+
+    def check_devices(self, on_checked=None):
+        """Scan for Kobo devices and tell the user when they change.
+        
+        on_checked(changed) is called afterwards, also if the scan failed.
+        """
         previous_devices = set(self.kobo_devices)
-        self.detect_kobo_devices()
-        current_devices = set(self.kobo_devices)
         
-        # If devices changed, update the UI
-        if previous_devices != current_devices:
-            if current_devices:
-                messagebox.showinfo("Device Detected", "A Kobo device has been detected.")
+        def on_scanned(devices):
+            self.update_device_list(devices)
+            current_devices = set(self.kobo_devices)
+            
+            # If devices changed, update the UI
+            changed = previous_devices != current_devices
+            if changed:
+                if current_devices:
+                    self.show_status("A Kobo device has been detected.")
+                else:
+                    self.show_status("No Kobo devices are currently connected.")
+            if on_checked:
+                on_checked(changed)
+        
+        def on_error(e):
+            log.error("Device detection failed", exc_info=e)
+            if on_checked:
+                on_checked(False)
+        
+        self.run_in_background(self.scan_kobo_drives, on_scanned, on_error)
+
+    # Longest wait between device checks while no device is connected
+    DEVICE_POLL_MAX_INTERVAL = 60000
+
+    # Wait between looks at the device change flag, in milliseconds
+    DEVICE_CHANGE_CHECK_INTERVAL = 250
+
+    def check_device_changed(self):
+        """Check for devices on the Tk thread once the device watcher has reported a change."""
+        if self._device_changed.is_set():
+            self._device_changed.clear()
+            self.check_devices()
+        self.root.after(self.DEVICE_CHANGE_CHECK_INTERVAL, self.check_device_changed)
+
+    def device_poll_interval(self):
+        """Return the base wait between device checks, in milliseconds."""
+        # Device notifications leave only a slow safety poll to do
+        return 30000 if self._device_watch.is_set() else 5000
+
+    def periodic_device_detection(self):
+        """Periodically check for Kobo devices.
+        
+        The wait doubles after each check that finds no device and no change,
+        up to DEVICE_POLL_MAX_INTERVAL, and drops back once a device shows up.
+        No scan is done while the window is minimized.
+        """
+        # Nobody is looking while the window is minimized; <Map> checks on restore
+        if self.root.state() == 'iconic':
+            self.root.after(self._device_poll_delay, self.periodic_device_detection)
+            return
+        
+        def schedule_next(changed):
+            if changed or self.kobo_devices:
+                self._device_poll_delay = self.device_poll_interval()
             else:
-                messagebox.showinfo("Device Removed", "No Kobo devices are currently connected.")
+                self._device_poll_delay = min(self._device_poll_delay * 2, self.DEVICE_POLL_MAX_INTERVAL)
+            # Schedule next check
+            self.root.after(self._device_poll_delay, self.periodic_device_detection)
         
-        # Schedule next check
-        self.root.after(5000, self.periodic_device_detection)
+        self.check_devices(schedule_next)
+
+def _merge_markup_one(args):
+    from PIL import Image
+    markup_path, page_path, max_size = args
+    # The page is opened for this merge alone, which draws on it in place
+    return KoboToJoplinApp.merge_markup_with_page(markup_path, Image.open(page_path), max_size)
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     root = tk.Tk()
     app = KoboToJoplinApp(root)
     root.mainloop()
\ No newline at end of file